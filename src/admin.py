@@ -1,24 +1,26 @@
 import flet as ft
 import models
-import json
 import socket
-from server import ChatServer
+from server import create_server
 import time
 import threading
 import bcrypt
 import sys
 from screeninfo import get_monitors
+from protocol import Channel
 
 HOST = "127.0.0.1"
 PORT = 5001
 RUNNING = False
-RELOAD = 2
+# user and group changes are pushed by the server; a full resync only guards against drift
+RESYNC = 60
+list_versions = {}  # {reply type: version of the list we hold}
 is_running = False
 
 def start_server():
     global server
     try:    
-        server = ChatServer()
+        server = create_server()
         server.start_background()
     except Exception as e:
         print(f"something went wrong in starting the server: {e}")
@@ -29,11 +31,12 @@ def start_server():
 def connect_to_server(username, page):
     global is_running
     #networking 
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client.connect((HOST, PORT))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect((HOST, PORT))
+    client = Channel(sock)
 
     # Introduce to server
-    send_control(client, {"type": "HELLO", "username": username})
+    client.hello(username)
     is_running = True
 
     recv_msg_thread = threading.Thread(target=recv_loop, args=(client, page), daemon=True)
@@ -555,59 +558,55 @@ class online_user(ft.Container):
 
 
 def get_all_users(client, username):
+    """Subscribes to user, presence and group changes, then now and then checks the lists are still current."""
     global is_running
 
+    client.send({"type": "SUBSCRIBE", "topics": ["users", "presence", "groups"]})
     while is_running:
+        time.sleep(RESYNC)
+        # answered with NOT_MODIFIED unless something changed since our copy
+        client.send({"type": "GetAllUser", "username": username, "version": list_versions.get("RecAllUser")})
+        client.send({"type": "GETALLGROUPS", "username": username, "version": list_versions.get("RECALLGROUPS")})
+
 
-        request_msg = {"type": "GetAllUser", "username": username}
-        send_control(sock=client, data=request_msg)
-        time.sleep(RELOAD)
-        
-        request_msg = {"type": "GETALLGROUPS", "username": username}
-        send_control(sock=client, data=request_msg)
-        time.sleep(RELOAD)
-
-
-
-def send_control(sock, data: dict):
-    """Send a JSON control message with a fixed header length"""
-    j = json.dumps(data).encode('utf-8')
-    header = f"{len(j):010d}".encode('utf-8')
-    sock.sendall(header + j)
-
-def recv_all(sock, n):
-    """Receive exactly n bytes"""
-    buf = bytearray()
-    while len(buf) < n:
-        chunk = sock.recv(n - len(buf))
-        if not chunk:
-            raise ConnectionError("Connection closed")
-        buf.extend(chunk)
-    return bytes(buf)
-
-def recv_control(sock):
-    """Receive a JSON control message"""
-    header = recv_all(sock, 10)
-    length = int(header.decode('utf-8'))
-    j = recv_all(sock, length)
-    return json.loads(j.decode('utf-8'))
 
 def recv_loop(client, page):
     global is_running
     global current_recipient
+    users = []
+    groups = []
 
     try:
         while is_running:
-            msg = recv_control(client)
+            msg = client.recv()
             # if msg["type"] == "PMSG_RECV":
             #     if current_recipient == msg["username"]:
             #         show_message(msg, page)
             #         page.update()
         
             if msg["type"] == "RecAllUser":
-                refresh_users(page, msg["text"], is_group=False)
+                users = list(msg["text"])
+                list_versions["RecAllUser"] = msg.get("version")
+                refresh_users(page, users, is_group=False)
+            elif msg["type"] == "USER_ADDED":
+                if msg["username"] not in users:
+                    users.append(msg["username"])
+                    refresh_users(page, users, is_group=False)
+            elif msg["type"] == "USER_REMOVED":
+                if msg["username"] in users:
+                    users.remove(msg["username"])
+                    refresh_users(page, users, is_group=False)
+            elif msg["type"] in ("ONLINE_USERS", "USER_JOIN", "USER_LEFT"):
+                # online status is read when the rows are built
+                refresh_users(page, users, is_group=False)
             elif msg["type"] == "RECALLGROUPS":
-                refresh_users(page, is_group=True, groups=msg["text"])
+                groups = list(msg["text"])
+                list_versions["RECALLGROUPS"] = msg.get("version")
+                refresh_users(page, is_group=True, groups=groups)
+            elif msg["type"] == "GROUP_ADDED":
+                if msg["group"] not in groups:
+                    groups.append(msg["group"])
+                    refresh_users(page, is_group=True, groups=groups)
             # elif msg["type"] == "RECV_HISTORY":
             #     update_user_messages(page, msg["text"])
 
@@ -0,0 +1,274 @@
+# async_server.py
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from protocol import FrameReader, READ_BUFFER_SIZE, encode_control
+from server import ChatServer, ClientConnection, FILE_CHUNK_SIZE
+
+# DB work and broadcasts still block, so they run on a small worker pool
+# instead of on the event loop itself.
+WORKER_THREADS = 8
+
+# =========================
+# asyncio helpers for the JSON protocol
+# =========================
+async def recv_control_async(reader, frames):
+    """Receive a control message, parsing it out of the FrameReader `frames`.
+
+    One stream read can hold many frames; the rest stay buffered in `frames`.
+    """
+    while True:
+        msg = frames.next_message()
+        if msg is not None:
+            return msg
+        data = await reader.read(READ_BUFFER_SIZE)
+        if not data:
+            raise ConnectionError("Connection closed")
+        frames.feed(data)
+
+
+class AsyncClientConnection(ClientConnection):
+    """ClientConnection whose writer is a task on the event loop.
+
+    Frames may still be queued from any thread; the writer task is woken
+    through the loop and is the only code that writes to the StreamWriter.
+    """
+    def __init__(self, loop, writer, username, policy):
+        super().__init__(writer, username, policy)
+        self.loop = loop
+        self.writer = writer
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        self.task = self.loop.create_task(self._write_loop())
+
+    def _call(self, func, *args):
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            func(*args)
+        else:
+            try:
+                self.loop.call_soon_threadsafe(func, *args)
+            except RuntimeError:
+                # loop already closed
+                pass
+
+    def _wake_writer(self):
+        self._call(self.wakeup.set)
+
+    async def _write_acked(self, frame, on_written):
+        self.writer.write(frame)
+        await self.writer.drain()
+        # on_written may touch the database, which must not stall the loop
+        await self.loop.run_in_executor(None, on_written)
+
+    async def _write_file(self, filepath, header, offset=0, count=None):
+        self.writer.write(header)
+        await self.writer.drain()
+        with open(filepath, "rb") as f:
+            # uses os.sendfile when the loop and platform allow it and falls
+            # back to buffered writes otherwise
+            await self.loop.sendfile(self.writer.transport, f, offset, count)
+
+    async def _write_loop(self):
+        try:
+            while True:
+                self.wakeup.clear()
+                batch = self._take_frames()
+                if batch is None:
+                    break
+                if not batch:
+                    await self.wakeup.wait()
+                elif callable(batch[0]):
+                    await batch[0]()
+                else:
+                    self.writer.writelines(batch)
+                    await self.writer.drain()
+        except Exception as e:
+            if not self.closed:
+                print(f"[SERVER] Writer for {self.username} stopped: {e}")
+        finally:
+            with self.cond:
+                self.closed = True
+                self.queue.clear()
+                self.queued_bytes = 0
+                self.cond.notify_all()
+            self.writer.close()
+
+    def _close_socket(self):
+        self._call(self.writer.close)
+
+
+# =========================
+# asyncio Chat Server
+# =========================
+class AsyncChatServer(ChatServer):
+    """ChatServer engine that serves every connection from a single event loop."""
+
+    def __init__(self, host="0.0.0.0", port=5001, policy=None, workers=WORKER_THREADS):
+        super().__init__(host, port, policy)
+        self.workers = workers
+        self.loop = None
+        self.executor = None
+        self.stop_event = None
+        self.handlers = {}  # {handler task: StreamWriter}, touched only on the loop
+
+    async def receive_file(self, reader, frames, conn, msg):
+        """Streams an upload to disk. Returns False if it was refused and the connection must close.
+
+        Opening (which rehashes a resumed partial), hashing and writing all
+        happen on the worker pool; only the socket reads stay on the loop.
+        """
+        upload = await self.loop.run_in_executor(self.executor, self.open_upload, conn, msg)
+        if upload is None:
+            return False
+        try:
+            # part of the file may already sit in the frame buffer
+            buffered = frames.take(upload.remaining)
+            if buffered:
+                await self.loop.run_in_executor(self.executor, upload.write, buffered)
+            while upload.remaining > 0:
+                chunk = await reader.read(min(FILE_CHUNK_SIZE, upload.remaining))
+                if not chunk:
+                    raise ConnectionError("Connection closed")
+                await self.loop.run_in_executor(self.executor, upload.write, chunk)
+            await self.loop.run_in_executor(self.executor, self.store_upload, conn.username, upload)
+        finally:
+            await self.loop.run_in_executor(self.executor, upload.abort)
+        return True
+
+    async def send_file_async(self, conn, msg):
+        # looks the file up on the worker pool; never blocks waiting for queue room
+        await self.loop.run_in_executor(self.executor, self.send_file, conn, msg, False)
+
+    async def serve_data(self, reader, frames, conn):
+        while True:
+            msg = await recv_control_async(reader, frames)
+            if msg["type"] == "FILE_META":
+                if not await self.receive_file(reader, frames, conn, msg):
+                    return
+            elif msg["type"] == "GET_FILE":
+                await self.send_file_async(conn, msg)
+            elif msg["type"] == "BYE":
+                return
+            else:
+                conn.send_control({"type": "ERROR", "message": f"{msg['type']} is not allowed on a data connection."})
+
+    async def handle_connection(self, reader, writer):
+        username = None
+        conn = None
+        data_conn = None
+        frames = FrameReader()
+        self.handlers[asyncio.current_task()] = writer
+        try:
+            hello_msg = await recv_control_async(reader, frames)
+            if hello_msg["type"] == "DATA_HELLO":
+                data_conn = AsyncClientConnection(self.loop, writer, None, self.policy)
+                if not self.attach_data_connection(data_conn, hello_msg):
+                    data_conn = None
+                    writer.write(encode_control({"type": "ERROR", "message": "Invalid or expired data token."}))
+                    return
+                frames.protocol = data_conn.protocol
+                data_conn.start()
+                await self.serve_data(reader, frames, data_conn)
+                return
+            if hello_msg["type"] != "HELLO":
+                return
+
+            username = hello_msg["username"]
+            print(f"hello {username}")
+
+            conn = AsyncClientConnection(self.loop, writer, username, self.policy)
+            if not self.register_client(username, conn, hello_msg):
+                conn = None
+                writer.write(encode_control({"type": "ERROR", "message": "Username already taken or connected."}))
+                return
+            frames.protocol = conn.protocol
+            conn.start()
+            await self.loop.run_in_executor(self.executor, self.deliver_missed, username)
+
+            while True:
+                msg = await recv_control_async(reader, frames)
+
+                if msg["type"] == "FILE_META":
+                    if not await self.receive_file(reader, frames, conn, msg):
+                        return
+
+                elif msg["type"] == "GET_FILE":
+                    await self.send_file_async(conn, msg)
+
+                elif msg["type"] == "BYE":
+                    return
+
+                else:
+                    await self.loop.run_in_executor(self.executor, self.dispatch_message, username, msg)
+
+        except Exception as e:
+            print(f"[SERVER ERROR] Error handling client {username}: {e}")
+
+        finally:
+            self.handlers.pop(asyncio.current_task(), None)
+            if conn:
+                self.remove_client(username, conn)
+                print(f"{username} has been removed")
+            elif data_conn:
+                self.detach_data_connection(data_conn)
+            else:
+                writer.close()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        aio_server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port, reuse_address=True
+        )
+        async with aio_server:
+            await self.stop_event.wait()
+
+    def start(self):
+        if self.running:
+            print("[SERVER] Server is already running.")
+            return
+
+        print(f"[SERVER] Starting asyncio engine on {self.host}:{self.port}")
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="chat-worker")
+        self.running = True
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            if self.running:
+                print(f"[SERVER ERROR] Event loop failed: {e}")
+        finally:
+            self.running = False
+            self.executor.shutdown(wait=False)
+            self.loop = None
+
+        print("[SERVER] Shut down.")
+
+    async def stop(self, conns, timeout=1.0):
+        """Gives closing connections a moment to flush, then stops the loop."""
+        tasks = [conn.task for conn in conns if conn.task]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        # closing the transports ends every handler's read, so none of them
+        # has to be cancelled when the loop goes away
+        for writer in list(self.handlers.values()):
+            writer.close()
+        if self.handlers:
+            await asyncio.wait(list(self.handlers), timeout=timeout)
+        self.stop_event.set()
+
+    def safe_shutdown(self):
+        if not self.running:
+            return
+
+        loop = self.loop
+        with self.lock:
+            conns = list(self.clients.values())
+        super().safe_shutdown()
+        if loop is not None:
+            asyncio.run_coroutine_threadsafe(self.stop(conns), loop)
@@ -2,11 +2,11 @@ import flet as ft
 import models
 import socket
 import threading
-import json
 import os
 import time
 from screeninfo import get_monitors
 import random
+from protocol import Channel
 
 # HOST = "192.168.43.213"
 HOST = "127.0.0.1"
@@ -14,8 +14,15 @@ HOST = "127.0.0.1"
 PORT = 5001
 is_running = False 
 DOWNLOAD_DIR = "downloaded/"
-RELOAD = 2
+# contact changes are pushed by the server; a full resync only guards against drift
+RESYNC = 60
+list_versions = {}  # {reply type: version of the list we hold}
+HISTORY_PAGE = 50  # messages per GET_HISTORY page
+load_older_button = None
+current_search = None
+search_more_button = None
 current_recipient = None
+current_group = None  # set instead of current_recipient while a group chat is open
 
 colors = {
     "red" : ft.Colors.RED,
@@ -36,63 +43,78 @@ def setup_download_directory(directory_name):
 def connect_to_server(username):
     global is_running
     #networking 
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client.connect((HOST, PORT))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect((HOST, PORT))
+    client = Channel(sock)
     # Introduce to server
-    send_control(client, {"type": "HELLO", "username": username})
+    client.hello(username)
     is_running = True
     # threading.Thread(target=recv_loop, daemon=True).start()
     print("connected")
     return client
 
-def get_historical_messages(user1, user2):
+def get_historical_messages(user1, user2, before_message_id=None):
+    """Asks for the newest page of history, or the page before `before_message_id`."""
     global client
     msg = {
         "type": "GET_HISTORY",
         "user1": user1,
         "user2": user2,
+        "limit": HISTORY_PAGE,
     }
+    if before_message_id is not None:
+        msg["before_message_id"] = before_message_id
     try:
-        send_control(client, msg)
+        client.send(msg)
     except Exception as e:
         print(f"something went wrong in get_historical_messages: {e}")
 
 
+def get_group_messages(group, before_message_id=None):
+    """Asks for the newest page of a group's messages, or the page before `before_message_id`."""
+    global client
+    msg = {
+        "type": "GET_HISTORY",
+        "user1": username,
+        "group": group,
+        "limit": HISTORY_PAGE,
+    }
+    if before_message_id is not None:
+        msg["before_message_id"] = before_message_id
+    try:
+        client.send(msg)
+    except Exception as e:
+        print(f"something went wrong in get_group_messages: {e}")
+
+def mark_read(peer, message_id):
+    """Tells the server we have read our chat with `peer` up to `message_id`."""
+    global client
+    try:
+        client.send({"type": "MARK_READ", "peer": peer, "message_id": message_id})
+    except Exception as e:
+        print(f"something went wrong in mark_read: {e}")
+
+def search_messages(query, offset=0):
+    """Asks the server for our messages matching `query`, from hit number `offset` on."""
+    global client
+    msg = {"type": "SEARCH", "query": query}
+    if offset:
+        msg["offset"] = offset
+    try:
+        client.send(msg)
+    except Exception as e:
+        print(f"something went wrong in search_messages: {e}")
+
 def get_all_users(client, username):
+    """Subscribes to contact and group changes, then now and then checks the lists are still current."""
     global is_running
 
+    client.send({"type": "SUBSCRIBE", "topics": ["users", "my_groups"]})
     while is_running:
-
-        request_msg = {"type": "GetAllUser", "username": username}
-        send_control(sock=client, data=request_msg)
-        time.sleep(RELOAD)
-        
-        request_msg = {"type": "GETUSERGROUPS", "username": username}
-        send_control(sock=client, data=request_msg)
-        time.sleep(RELOAD)
-
-def send_control(sock, data: dict):
-    """Send a JSON control message with a fixed header length"""
-    j = json.dumps(data).encode('utf-8')
-    header = f"{len(j):010d}".encode('utf-8')
-    sock.sendall(header + j)
-
-def recv_all(sock, n):
-    """Receive exactly n bytes"""
-    buf = bytearray()
-    while len(buf) < n:
-        chunk = sock.recv(n - len(buf))
-        if not chunk:
-            raise ConnectionError("Connection closed")
-        buf.extend(chunk)
-    return bytes(buf)
-
-def recv_control(sock):
-    """Receive a JSON control message"""
-    header = recv_all(sock, 10)
-    length = int(header.decode('utf-8'))
-    j = recv_all(sock, length)
-    return json.loads(j.decode('utf-8'))
+        time.sleep(RESYNC)
+        # answered with NOT_MODIFIED unless something changed since our copy
+        client.send({"type": "GetAllUser", "username": username, "version": list_versions.get("RecAllUser")})
+        client.send({"type": "GETUSERGROUPS", "username": username, "version": list_versions.get("RECUSERGROUPS")})
 
 def show_message(msg, page):       
     sender = msg["username"]
@@ -128,23 +150,66 @@ def show_message(msg, page):
 def recv_loop(client, page):
     global is_running
     global current_recipient
+    users = []
+    groups = []
 
     try:
         while is_running:
-            msg = recv_control(client)
+            msg = client.recv()
             if msg["type"] == "PMSG_RECV":
                 if current_recipient == msg["username"]:
                     show_message(msg, page)
                     page.update()
+                    if "message_id" in msg:
+                        mark_read(msg["username"], msg["message_id"])
         
             elif msg["type"] == "RecAllUser":
-                update_contacts_ui(page, msg["text"], is_group=False)
+                users = list(msg["text"])
+                list_versions["RecAllUser"] = msg.get("version")
+                update_contacts_ui(page, users, is_group=False)
+
+            elif msg["type"] == "USER_ADDED":
+                if msg["username"] not in users:
+                    users.append(msg["username"])
+                    update_contacts_ui(page, users, is_group=False)
+
+            elif msg["type"] == "USER_REMOVED":
+                if msg["username"] in users:
+                    users.remove(msg["username"])
+                    update_contacts_ui(page, users, is_group=False)
 
             elif msg["type"] == "RECUSERGROUPS":
-                update_contacts_ui(page, is_group=True, groups=msg["text"])
+                groups = list(msg["text"])
+                list_versions["RECUSERGROUPS"] = msg.get("version")
+                update_contacts_ui(page, is_group=True, groups=groups)
+
+            elif msg["type"] == "GROUP_JOINED":
+                if msg["group"] not in groups:
+                    groups.append(msg["group"])
+                    update_contacts_ui(page, is_group=True, groups=groups)
+
+            elif msg["type"] == "GROUP_LEFT":
+                if msg["group"] in groups:
+                    groups.remove(msg["group"])
+                    update_contacts_ui(page, is_group=True, groups=groups)
+
+            elif msg["type"] == "GMSG_RECV":
+                if current_group == msg["group"]:
+                    show_message(msg, page)
+
+            elif msg["type"] == "SEARCH_RESULTS":
+                show_search_results(page, msg)
+
+            elif msg["type"] == "MISSED_MESSAGES":
+                show_missed_messages(page, msg["messages"])
 
             elif msg["type"] == "RECV_HISTORY":
-                update_user_messages(page, msg["text"])
+                # skip pages for a chat we already left
+                if "group" in msg and msg["group"] != current_group:
+                    pass
+                elif msg.get("user2", current_recipient) == current_recipient:
+                    update_user_messages(page, msg["text"], msg.get("cursor"),
+                                         older=msg.get("before_message_id") is not None)
 
                 # if msg["type"] == "MSG":
                 #     self.show_msg(f"{msg['username']}: {msg['text']}")
@@ -178,7 +243,7 @@ class Group(ft.Container):
                         border_radius=10,
                         margin= ft.margin.only(0,0,0,5),
                         ink=True,
-                        # on_click=self.group_profile
+                        on_click=self.on_click
                         )
 
         self.group_name = group_name
@@ -201,6 +266,21 @@ class Group(ft.Container):
                     ft.Text(self.group_name, size=20),                       
                 ],
             )
+
+    def on_click(self, e):
+        global current_recipient
+        global current_group
+        current_recipient = None
+        current_group = self.group_name
+        unlock_input()
+        chat_list_view.controls.clear()
+        chat_list_view.controls.append(
+            ft.Text(f" -- Group {self.group_name} -- ", size=20, weight=ft.FontWeight.BOLD)
+        )
+
+        self.page.update()
+
+        get_group_messages(self.group_name)
         
 
 class contact:
@@ -240,8 +320,10 @@ class contact:
 
     def on_click(self, e):
         global current_recipient
+        global current_group
         current_recipient = self.name
-        self.unlock_input()
+        current_group = None
+        unlock_input()
         chat_list_view.controls.clear()
         chat_list_view.controls.append(
             ft.Text(f" -- Chat With {self.name} -- ", size=20, weight=ft.FontWeight.BOLD)
@@ -253,11 +335,11 @@ class contact:
         
         
 
-    def unlock_input(self):
-            if text_input.disabled and send_button.disabled and select_file_button.disabled:
-                text_input.disabled = False
-                send_button.disabled = False
-                select_file_button.disabled = False
+def unlock_input():
+    if text_input.disabled and send_button.disabled and select_file_button.disabled:
+        text_input.disabled = False
+        send_button.disabled = False
+        select_file_button.disabled = False
 
     
     
@@ -286,45 +368,113 @@ def update_contacts_ui(page, users: list = None, is_group: bool= False, groups:
     page.update()
     print("cantacts are reloaded!")
 
-def update_user_messages(page, messages):
+def message_row(msg):
+    sender = msg["sender"]
+    text = msg["text"]
+    
+    # Format the message for the chat window
+    is_current_user_message = (sender == username)
+    
+    username_span_text = f"{sender}: "
+    if is_current_user_message:
+        # Align to the right and use a different style for self-sent messages
+        text_style = ft.TextStyle(size=16, color="#787878", italic=True)
+        alignment = ft.MainAxisAlignment.END
+    else:
+        # Align to the left for messages from the contact
+        text_style = ft.TextStyle(size=16, color=ft.Colors.BLUE_GREY_100, italic=True)
+        alignment = ft.MainAxisAlignment.START
+
+    return ft.Row(
+        [
+            ft.Text(
+                spans=[
+                    ft.TextSpan(username_span_text, style=text_style),
+                    ft.TextSpan(text, style=ft.TextStyle(color=ft.Colors.WHITE))
+                ],
+                size=18
+            )
+        ],
+        alignment=alignment # Align messages based on sender
+    )
+
+def update_user_messages(page, messages, cursor=None, older=False):
+    """Shows a page of history: appended if it is the newest, else above what is shown.
+
+    With a cursor there are older messages, and a button under the chat
+    header loads them.
+    """
+    global load_older_button
 
-    # 5. Display the loaded messages
+    rows = [message_row(msg) for msg in messages]
+    if load_older_button in chat_list_view.controls:
+        chat_list_view.controls.remove(load_older_button)
+    if older:
+        # controls[0] is the "Chat With" header
+        chat_list_view.controls[1:1] = rows
+    else:
+        chat_list_view.controls.extend(rows)
+        # the newest page of a private chat is on screen, so it has been read
+        if messages and current_recipient and "message_id" in messages[-1]:
+            mark_read(current_recipient, messages[-1]["message_id"])
+
+    if cursor is not None:
+        recipient, group = current_recipient, current_group
+        load_older_button = ft.TextButton(
+            "Load older messages",
+            on_click=lambda e: get_group_messages(group, cursor) if group
+                               else get_historical_messages(username, recipient, cursor)
+        )
+        chat_list_view.controls.insert(1, load_older_button)
+
+    page.update()
+
+
+def show_missed_messages(page, messages):
+    """Shows what arrived while we were offline: in the open chat, else as a notice."""
+    senders = []
+    last_read = None
     for msg in messages:
-        sender = msg["sender"]
-        text = msg["text"]
-        
-        # Format the message for the chat window
-        is_current_user_message = (sender == username)
-        
-        # Use the existing show_messege logic for consistency, 
-        # or define a simple display logic here
-        
-        username_span_text = f"{sender}: "
-        if is_current_user_message:
-            # Align to the right and use a different style for self-sent messages
-            text_style = ft.TextStyle(size=16, color="#787878", italic=True)
-            alignment = ft.MainAxisAlignment.END
-        else:
-            # Align to the left for messages from the contact
-            text_style = ft.TextStyle(size=16, color=ft.Colors.BLUE_GREY_100, italic=True)
-            alignment = ft.MainAxisAlignment.START
+        if msg["sender"] == current_recipient:
+            chat_list_view.controls.append(message_row(msg))
+            last_read = msg["message_id"]
+        elif msg["sender"] not in senders:
+            senders.append(msg["sender"])
+    if last_read is not None:
+        mark_read(current_recipient, last_read)
+    if senders:
+        page.open(ft.SnackBar(ft.Text(f"New messages from {', '.join(senders)}")))
+    page.update()
 
-        chat_list_view.controls.append(
-            ft.Row(
-                [
-                    ft.Text(
-                        spans=[
-                            ft.TextSpan(username_span_text, style=text_style),
-                            ft.TextSpan(text, style=ft.TextStyle(color=ft.Colors.WHITE))
-                        ],
-                        size=18
-                    )
-                ],
-                alignment=alignment # Align messages based on sender
+
+def show_search_results(page, msg):
+    """Lists SEARCH hits in the search dialog, with a button for the next page."""
+    global search_more_button
+
+    # results of an older search
+    if msg["query"] != current_search:
+        return
+    if search_more_button in search_results.controls:
+        search_results.controls.remove(search_more_button)
+    if not msg["results"] and not search_results.controls:
+        search_results.controls.append(ft.Text("No messages found."))
+
+    for hit in msg["results"]:
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(hit["sent_at"]))
+        search_results.controls.append(
+            ft.ListTile(
+                title=ft.Text(hit["text"]),
+                subtitle=ft.Text(f"{hit['sender']} → {hit['recipient']}   {when}")
             )
         )
 
-    
+    if msg["next_offset"] is not None:
+        search_more_button = ft.TextButton(
+            "More results",
+            on_click=lambda e: search_messages(msg["query"], msg["next_offset"])
+        )
+        search_results.controls.append(search_more_button)
+
     page.update()
 
 
@@ -337,6 +487,7 @@ def user_chat(page):
     global online_users_container
     global all_groups_container
     global client
+    global search_results
 
     width, height = get_monitor_info()
     """Creates the login screen View."""
@@ -355,7 +506,10 @@ def user_chat(page):
         recipient = current_recipient
         if msg:
             show_messege(msg.strip())
-            send_control(client, {"type": "PMSG","username": username, "recipient":recipient, "text": msg.strip()})
+            if current_group:
+                client.send({"type": "GMSG", "username": username, "group": current_group, "text": msg.strip()})
+            else:
+                client.send({"type": "PMSG","username": username, "recipient":recipient, "text": msg.strip()})
 
     def show_messege(msg):
         text_style = ft.TextStyle(size=16, color="#787878", italic=True)
@@ -381,6 +535,27 @@ def user_chat(page):
 
         page.update()
 
+    def run_search(e):
+        global current_search
+        query = search_input.value.strip()
+        if query:
+            current_search = query
+            search_results.controls.clear()
+            page.update()
+            search_messages(query)
+
+    #search over our own conversations
+    search_input = ft.TextField(label="Search messages", width=450, autofocus=True, on_submit=run_search)
+    search_results = ft.ListView(controls=[], width=450, height=400)
+    search_dialog = ft.AlertDialog(
+        title=ft.Text("Search"),
+        content=ft.Column([search_input, search_results], tight=True),
+        actions=[
+            ft.TextButton("Close", on_click=lambda e: e.page.close(search_dialog)),
+            ft.ElevatedButton("Search", on_click=run_search),
+        ]
+    )
+
     #it contains users in contact tab
     online_users_container = ft.ListView(
             controls=[]
@@ -505,7 +680,7 @@ def user_chat(page):
     def on_app_close(e):
         if e.data == "close":
             print("closing the client")
-            send_control(client, {"type": "QUIT"})
+            client.send({"type": "QUIT"})
             time.sleep(2)
             print("closed")
 
@@ -534,7 +709,7 @@ def user_chat(page):
             center_title=True,
             bgcolor="#001F2E",
             actions=[
-                ft.IconButton(ft.Icons.SEARCH, on_click=lambda e: print("Search clicked")),
+                ft.IconButton(ft.Icons.SEARCH, on_click=lambda e: e.page.open(search_dialog)),
                 ft.IconButton(ft.Icons.MORE_VERT, on_click=lambda e: print("More clicked")),
             ],
         )
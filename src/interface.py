@@ -7,11 +7,15 @@ from ttkbootstrap.window import Window
 from ttkbootstrap.scrolled import ScrolledText
 import threading
 import socket
-import json
 import os 
+from collections import deque
 from tkinter.simpledialog import askstring
+from protocol import Channel, file_sha256
 
 DOWNLOAD_DIR = "downloaded/"
+# unfinished downloads keep this suffix, and the next request resumes them
+PARTIAL_SUFFIX = ".part"
+FILE_CHUNK_SIZE = 64 * 1024
 
 
 def setup_download_directory(directory_name):
@@ -21,29 +25,6 @@ def setup_download_directory(directory_name):
     else:
         print(f"[CLIENT] Download directory '{directory_name}' found.")
  
-def send_control(sock, data: dict):
-    """Send a JSON control message with a fixed header length"""
-    j = json.dumps(data).encode('utf-8')
-    header = f"{len(j):010d}".encode('utf-8')
-    sock.sendall(header + j)
-
-def recv_all(sock, n):
-    """Receive exactly n bytes"""
-    buf = bytearray()
-    while len(buf) < n:
-        chunk = sock.recv(n - len(buf))
-        if not chunk:
-            raise ConnectionError("Connection closed")
-        buf.extend(chunk)
-    return bytes(buf)
-
-def recv_control(sock):
-    """Receive a JSON control message"""
-    header = recv_all(sock, 10)
-    length = int(header.decode('utf-8'))
-    j = recv_all(sock, length)
-    return json.loads(j.decode('utf-8'))
-
 
 class App(tb.Toplevel):
     def __init__(self, parent, theme_name, username= "User", host="127.0.0.1", port=5000):
@@ -130,11 +111,19 @@ class App(tb.Toplevel):
         #networking 
         self.host = host
         self.port = port
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client.connect((self.host, self.port))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((self.host, self.port))
+        self.client = Channel(sock)
 
         # Introduce to server
-        send_control(self.client, {"type": "HELLO", "username": self.username})
+        self.client.send({"type": "HELLO", "username": self.username})
+        self.reader = self.client.reader
+        # file transfers waiting for their DATA_TOKEN, in request order
+        self.pending_transfers = deque()
+        # the server's file catalog: a FILE_LIST once, then FILE_LIST_DELTA updates
+        self.files = {}
+        self.catalog_version = None
+        self.client.send({"type": "GET_FILE_LIST"})
 
         self.running = True
         threading.Thread(target=self.recv_loop, daemon=True).start()
@@ -146,7 +135,7 @@ class App(tb.Toplevel):
         text = self.message_entry.get().strip()
         if not text:
             return
-        send_control(self.client, {"type": "MSG", "text": text})
+        self.client.send({"type": "MSG", "text": text})
         self.entry_var.set("")
 
     def show_msg(self, msg):
@@ -164,22 +153,46 @@ class App(tb.Toplevel):
     # =========================
     # File functions
     # =========================
+    # Files travel over their own data connection, so chat keeps flowing on
+    # self.client while they transfer: ask for a DATA_TOKEN, and recv_loop
+    # runs the transfer on a new connection once it arrives.
+    def start_transfer(self, transfer):
+        self.pending_transfers.append(transfer)
+        self.client.send({"type": "GET_DATA_TOKEN"})
+
+    def run_transfer(self, token, transfer):
+        try:
+            data = self.client.open_data_channel(token)
+        except OSError as e:
+            self.after(0, self.show_msg, f"[Error: could not open data connection: {e}]")
+            return
+        try:
+            transfer(data)
+            data.send({"type": "BYE"})
+        except (OSError, ConnectionError) as e:
+            self.after(0, self.show_msg, f"[Error: file transfer interrupted: {e}]")
+        finally:
+            data.close()
+
     def send_file(self):
         filepath = filedialog.askopenfilename(title="Choose file")
         if not filepath:
             return
-        filesize = os.path.getsize(filepath)
         filename = os.path.basename(filepath)
-
-        # Send metadata first
-        send_control(self.client, {"type": "FILE_META", "filename": filename, "filesize": filesize})
-
-        # Send file data
-        with open(filepath, "rb") as f:
-            while chunk := f.read(4096):
-                self.client.sendall(chunk)
-
-        self.show_msg(f"[You uploaded file: {filename}]")
+        self.start_transfer(lambda data: self.upload_over(data, filepath, filename))
+        self.show_msg(f"[Uploading file: {filename}]")
+
+    def upload_over(self, data, filepath, filename):
+        # the server answers with FILE_RESUME, saying how much of the file
+        # an earlier, interrupted attempt already delivered
+        data.send({"type": "FILE_META", "filename": filename, "filesize": os.path.getsize(filepath),
+                   "sha256": file_sha256(filepath), "resume": True})
+        reply = data.recv()
+        if reply["type"] != "FILE_RESUME":
+            self.after(0, self.show_msg, "[Error: " + reply.get("message", "") + "]")
+            return
+        data.send_file(filepath, int(reply["offset"]))
+        self.after(0, self.show_msg, f"[You uploaded file: {filename}]")
 
     def download_file(self):
         selection = self.file_listbox.selection()
@@ -192,15 +205,68 @@ class App(tb.Toplevel):
         if not filename:
             return
 
-        send_control(self.client, {"type": "GET_FILE", "filename": filename})
+        # rows from a file store are keyed by file_id; names can repeat
+        file_id = int(selected_item_id) if selected_item_id.isdigit() else None
+        self.start_transfer(lambda data: self.download_over(data, filename, file_id))
         self.show_msg(f"[Requesting file: {filename}]")
+
+    def download_over(self, data, filename, file_id=None):
+        request = {"type": "GET_FILE", "filename": filename}
+        if file_id is not None:
+            request["file_id"] = file_id
+        # names repeat, so a partial belongs to one file_id; resuming it
+        # with another file's bytes would splice two files together
+        partial_name = f"{file_id}-{filename}" if file_id is not None else filename
+        partial = DOWNLOAD_DIR + partial_name + PARTIAL_SUFFIX
+        if os.path.exists(partial):
+            request["offset"] = os.path.getsize(partial)
+        data.send(request)
+
+        msg = data.recv()
+        if msg["type"] != "FILE_SEND":
+            self.after(0, self.show_msg, "[Error: " + msg.get("message", "") + "]")
+            return
+        filesize = int(msg["filesize"])
+        offset = int(msg.get("offset", 0))
+        remaining = int(msg.get("length", filesize))
         
+        self.after(0, self.show_msg, f"[Receiving file: {filename} ({filesize} bytes)...]")
+        
+        setup_download_directory(DOWNLOAD_DIR) 
+        # written to the .part file as it arrives, so a dropped
+        # connection leaves something to resume from
+        with open(partial, "r+b" if offset and os.path.exists(partial) else "wb") as f:
+            f.seek(offset)
+            f.truncate()
+            buf = memoryview(bytearray(FILE_CHUNK_SIZE))
+            while remaining > 0:
+                n = data.reader.readinto(buf[:min(len(buf), remaining)])
+                f.write(buf[:n])
+                remaining -= n
+        os.replace(partial, DOWNLOAD_DIR + filename)
+        
+        self.after(0, self.show_msg, f"[Downloaded file: {filename}]")
+        
+    def apply_file_delta(self, delta):
+        """Applies a FILE_LIST_DELTA (recv thread); returns False if deltas were missed."""
+        if self.catalog_version is None or delta["version"] <= self.catalog_version:
+            return True
+        if delta["version"] != self.catalog_version + 1:
+            return False
+        for f in delta["added"]:
+            self.files[f["file_id"]] = f
+        for file_id in delta["removed"]:
+            self.files.pop(file_id, None)
+        self.catalog_version = delta["version"]
+        return True
+
     def update_file_list(self, files):
         """Updates the Treeview list of files (must be called from Main Thread)."""
         if self.file_listbox.winfo_exists():
             self.file_listbox.delete(*self.file_listbox.get_children())
             for f in files:
-                self.file_listbox.insert("", "end", text=f["filename"], values=(f["filesize"],))
+                iid = str(f["file_id"]) if "file_id" in f else None
+                self.file_listbox.insert("", "end", iid=iid, text=f["filename"], values=(f["filesize"],))
                 
     # =========================
     # Receiving loop
@@ -208,7 +274,7 @@ class App(tb.Toplevel):
     def recv_loop(self):
         try:
             while self.running:
-                msg = recv_control(self.client)
+                msg = self.reader.recv_control()
 
                 if msg["type"] == "MSG":
                     self.after(0, self.show_msg, f"{msg['username']}: {msg['text']}")
@@ -219,19 +285,19 @@ class App(tb.Toplevel):
                 elif msg["type"] == "FILE_NOTICE":
                     self.after(0, self.show_msg, f"[{msg['username']} uploaded file: {msg['filename']}]")
                 elif msg["type"] == "FILE_LIST":
-                    self.after(0, self.update_file_list, msg["files"])
-                elif msg["type"] == "FILE_SEND":
-                    filename = msg["filename"]
-                    filesize = int(msg["filesize"])
-                    
-                    self.after(0, self.show_msg, f"[Receiving file: {filename} ({filesize} bytes)...]")
-                    
-                    file_data = recv_all(self.client, filesize)
-                    setup_download_directory(DOWNLOAD_DIR) 
-                    with open(DOWNLOAD_DIR + filename, "wb") as f:
-                        f.write(file_data)
-                    
-                    self.after(0, self.show_msg, f"[Downloaded file: {filename}]")
+                    self.files = {f.get("file_id", i): f for i, f in enumerate(msg["files"])}
+                    self.catalog_version = msg.get("version")
+                    self.after(0, self.update_file_list, list(self.files.values()))
+                elif msg["type"] == "FILE_LIST_DELTA":
+                    if self.apply_file_delta(msg):
+                        self.after(0, self.update_file_list, list(self.files.values()))
+                    else:
+                        # missed a change: fetch what we lack (or the whole list)
+                        self.client.send({"type": "GET_FILE_LIST", "version": self.catalog_version})
+                elif msg["type"] == "DATA_TOKEN":
+                    if self.pending_transfers:
+                        transfer = self.pending_transfers.popleft()
+                        threading.Thread(target=self.run_transfer, args=(msg["token"], transfer), daemon=True).start()
                 
                 elif msg["type"] == "KICKED":
                     self.after(0, self.show_msg, f"[SERVER]: {msg.get('message', 'You were disconnected by the admin.')}")
@@ -261,7 +327,7 @@ class App(tb.Toplevel):
 
         if not kicked:
             try:
-                send_control(self.client, {"type": "QUIT"})
+                self.client.send({"type": "QUIT"})
             except:
                 pass
         
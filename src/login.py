@@ -7,7 +7,7 @@ from ttkbootstrap.dialogs import Messagebox
 import server_interface
 import interface
 import sqlite3, bcrypt
-from server import ChatServer
+from server import create_server
 import models 
 
 # --- [تعریف نام تم] ---
@@ -30,7 +30,7 @@ def show_chatroom(parent, username, role):
         app.mainloop()
     elif role == "admin":
         parent.withdraw()
-        srv = ChatServer()
+        srv = create_server()
         if not srv.running:
              srv.start_background()
         
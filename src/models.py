@@ -1,7 +1,10 @@
 # models.py
+import atexit
 import sqlite3
 import bcrypt
 import os
+import queue
+import threading
 import time
 
 current_dir = os.getcwd()
@@ -24,9 +27,292 @@ def check_password_hash(password, password_hash):
     """Checks a plain password against a stored hash."""
     return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
 
+# =========================
+# Connection pool
+# =========================
+# Connections are kept open between calls, so a query no longer pays for
+# opening the file and parsing the schema. Each one is used by a single
+# thread at a time, and at most DB_POOL_SIZE are open: callers beyond that
+# wait for one to be released. Code holding a connection passes it on
+# (conn=...) instead of taking a second one.
+DB_POOL_SIZE = 8
+DB_BUSY_TIMEOUT = 5.0  # seconds to wait for another connection's write lock
+DB_CACHE_KB = 8 * 1024
+
+# How message writes reach the disk. Set before the first connection is opened.
+#   "batched": add_message_db queues the message and the writer thread commits
+#              everything queued within MESSAGE_FLUSH_INTERVAL in one transaction
+#              (synchronous=NORMAL); a crash can lose the last few milliseconds.
+#   "sync":    each message is committed, with synchronous=FULL, before
+#              add_message_db returns.
+DURABILITY_MODES = ("batched", "sync")
+DB_DURABILITY = os.environ.get("CHAT_DB_DURABILITY", "batched")
+
+_pool = []       # idle connections
+_pool_open = 0   # idle plus handed out
+_pool_cond = threading.Condition()
+
+def _connect():
+    conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_KB}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute(f"PRAGMA synchronous = {'FULL' if DB_DURABILITY == 'sync' else 'NORMAL'}")
+    return conn
+
 def get_db_connection():
-    """Returns a new database connection."""
-    return sqlite3.connect(DB_FILE)
+    """Returns a pooled database connection, waiting while all DB_POOL_SIZE are in use.
+
+    Give it back with release_db_connection().
+    """
+    global _pool_open
+    with _pool_cond:
+        while not _pool and _pool_open >= DB_POOL_SIZE:
+            _pool_cond.wait()
+        if _pool:
+            return _pool.pop()
+        _pool_open += 1
+    try:
+        return _connect()
+    except Exception:
+        _discard_connection(None)
+        raise
+
+def _discard_connection(conn):
+    global _pool_open
+    if conn is not None:
+        conn.close()
+    with _pool_cond:
+        _pool_open -= 1
+        _pool_cond.notify()
+
+def release_db_connection(conn):
+    """Returns a connection to the pool, rolling back anything left uncommitted."""
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.Error:
+        _discard_connection(conn)
+        return
+    with _pool_cond:
+        _pool.append(conn)
+        _pool_cond.notify()
+
+# =========================
+# Change notifications
+# =========================
+# Called after a user, group or membership change is committed, so the server
+# can push it to subscribed clients instead of having them poll.
+_change_listeners = []
+
+def add_change_listener(listener):
+    """Registers listener(event, **details) for committed changes.
+
+    Events: "user_added" / "user_removed" (username), "group_added" (group_name),
+    "member_added" / "member_removed" (username, group_name).
+    """
+    _change_listeners.append(listener)
+
+def _notify(event, **details):
+    for listener in list(_change_listeners):
+        try:
+            listener(event, **details)
+        except Exception as e:
+            print(f"[DB ERROR] Change listener failed for {event}: {e}")
+
+# =========================
+# Identity cache
+# =========================
+# username <-> user_id for every user, loaded by init_db and kept current by
+# add_user_db / remove_user_db, so the message path does no lookup queries.
+_user_ids = {}   # {username: user_id}
+_usernames = {}  # {user_id: username}
+_identity_lock = threading.Lock()
+
+def _remember_user(username, user_id):
+    with _identity_lock:
+        _user_ids[username] = user_id
+        _usernames[user_id] = username
+
+def _forget_user(username):
+    with _identity_lock:
+        user_id = _user_ids.pop(username, None)
+        _usernames.pop(user_id, None)
+
+# =========================
+# Membership index
+# =========================
+# Groups and memberships by integer id in both directions, loaded by init_db
+# and written through by add_group_db / add_user_to_group_db /
+# remove_user_from_group_db, so membership reads never touch SQLite.
+_group_ids = {}         # {group name: group_id}
+_group_names = {}       # {group_id: group name}
+_members_by_group = {}  # {group_id: set of user_ids}
+_groups_by_user = {}    # {user_id: set of group_ids}
+_membership_lock = threading.Lock()
+_membership_loaded = False
+
+def _load_membership_index(conn):
+    global _membership_loaded
+    groups = conn.execute("SELECT group_id, name FROM groups").fetchall()
+    # rows of deleted users can outlive them (foreign keys are not enforced)
+    members = conn.execute("""
+        SELECT T1.group_id, T1.user_id FROM group_members T1
+        JOIN users T2 ON T1.user_id = T2.user_id
+    """).fetchall()
+    with _membership_lock:
+        _group_ids.clear()
+        _group_names.clear()
+        _members_by_group.clear()
+        _groups_by_user.clear()
+        for group_id, name in groups:
+            _group_ids[name] = group_id
+            _group_names[group_id] = name
+            _members_by_group[group_id] = set()
+        for group_id, user_id in members:
+            _members_by_group.setdefault(group_id, set()).add(user_id)
+            _groups_by_user.setdefault(user_id, set()).add(group_id)
+        _membership_loaded = True
+
+def _index_group(group_name, group_id):
+    with _membership_lock:
+        _group_ids[group_name] = group_id
+        _group_names[group_id] = group_name
+        _members_by_group.setdefault(group_id, set())
+
+def _index_membership(user_id, group_id, is_member):
+    with _membership_lock:
+        if is_member:
+            _members_by_group.setdefault(group_id, set()).add(user_id)
+            _groups_by_user.setdefault(user_id, set()).add(group_id)
+        else:
+            _members_by_group.get(group_id, set()).discard(user_id)
+            _groups_by_user.get(user_id, set()).discard(group_id)
+
+def _unindex_user(user_id):
+    with _membership_lock:
+        for group_id in _groups_by_user.pop(user_id, ()):
+            _members_by_group.get(group_id, set()).discard(user_id)
+
+def is_group_member(username, group_name):
+    """Whether `username` belongs to `group_name`, from the membership index."""
+    if not _membership_loaded:
+        return username in get_group_members_db(group_name)
+    user_id = _user_ids.get(username)
+    with _membership_lock:
+        group_id = _group_ids.get(group_name)
+        return user_id in _members_by_group.get(group_id, ())
+
+def _load_identity_cache(conn):
+    rows = conn.execute("SELECT username, user_id FROM users").fetchall()
+    with _identity_lock:
+        _user_ids.clear()
+        _usernames.clear()
+        for username, user_id in rows:
+            _user_ids[username] = user_id
+            _usernames[user_id] = username
+
+# =========================
+# Message search
+# =========================
+# messages_fts is an external-content FTS5 index over private messages, kept
+# in step by triggers. Next to the text it indexes their participants as
+# "u<sender id> u<recipient id>", so a user's search is narrowed inside the
+# index before any ranking. Builds of SQLite without FTS5 just go without search.
+search_available = False
+
+def _init_message_search(cur):
+    global search_available
+    try:
+        columns = [row[1] for row in cur.execute("PRAGMA table_info(messages_fts)")]
+        if columns and "participants" not in columns:
+            # the index from before participants were indexed
+            for trigger in ("insert", "delete", "update"):
+                cur.execute(f"DROP TRIGGER IF EXISTS messages_fts_{trigger}")
+            cur.execute("DROP TABLE messages_fts")
+            columns = []
+        cur.execute("""
+            CREATE VIEW IF NOT EXISTS messages_search AS
+            SELECT message_id, text,
+                   'u' || sender_user_id || ' u' || recipient_user_id AS participants
+            FROM messages
+            WHERE is_group_message = 0 AND recipient_user_id IS NOT NULL""")
+        cur.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+            USING fts5(text, participants, content='messages_search', content_rowid='message_id')""")
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+            WHEN new.is_group_message = 0 AND new.recipient_user_id IS NOT NULL BEGIN
+                INSERT INTO messages_fts (rowid, text, participants)
+                VALUES (new.message_id, new.text, 'u' || new.sender_user_id || ' u' || new.recipient_user_id);
+            END""")
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+            WHEN old.is_group_message = 0 AND old.recipient_user_id IS NOT NULL BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, text, participants)
+                VALUES ('delete', old.message_id, old.text, 'u' || old.sender_user_id || ' u' || old.recipient_user_id);
+            END""")
+        cur.execute("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages
+            WHEN new.is_group_message = 0 AND new.recipient_user_id IS NOT NULL BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, text, participants)
+                VALUES ('delete', old.message_id, old.text, 'u' || old.sender_user_id || ' u' || old.recipient_user_id);
+                INSERT INTO messages_fts (rowid, text, participants)
+                VALUES (new.message_id, new.text, 'u' || new.sender_user_id || ' u' || new.recipient_user_id);
+            END""")
+        if not columns:
+            # index the messages stored before search existed
+            cur.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            print("[DB INFO] Built the message search index.")
+        search_available = True
+    except sqlite3.OperationalError as e:
+        print(f"[DB INFO] Message search is unavailable: {e}")
+
+def _fts_query(user_id, text):
+    """Turns free text into an FTS5 query for user_id's messages matching every word, each as a literal."""
+    words = " AND ".join('text : "' + word.replace('"', '""') + '"' for word in text.split())
+    return f'participants : "u{user_id}" AND {words}'
+
+def search_messages_db(username, text, limit, offset=0, conn=None):
+    """
+    Finds private messages sent or received by `username` that contain every
+    word of `text`, best matches first. Returns (messages, next_offset);
+    next_offset is None when there are no more hits.
+    """
+    if not search_available or not text.split():
+        return [], None
+    flush_messages()
+    close_conn = False
+    if conn is None:
+        conn = get_db_connection()
+        close_conn = True
+    try:
+        cur = conn.cursor()
+        user_id = get_user_id_by_username(username, conn)
+        if user_id is None:
+            print(f"[DB ERROR] User '{username}' not found.")
+            return [], None
+
+        cur.execute("""
+            SELECT T2.message_id, T1.username AS sender, T3.username AS recipient, T2.text, T2.sent_at
+            FROM messages_fts F
+            JOIN messages T2 ON T2.message_id = F.rowid
+            JOIN users T1 ON T2.sender_user_id = T1.user_id
+            JOIN users T3 ON T2.recipient_user_id = T3.user_id
+            WHERE messages_fts MATCH ?
+            ORDER BY F.rank
+            LIMIT ? OFFSET ?
+        """, (_fts_query(user_id, text), limit + 1, offset))
+        rows = cur.fetchall()
+
+        messages = [{"message_id": row[0], "sender": row[1], "recipient": row[2],
+                     "text": row[3], "sent_at": row[4]} for row in rows[:limit]]
+        return messages, offset + limit if len(rows) > limit else None
+    except Exception as e:
+        print(f"[DB ERROR] Message search failed: {e}")
+        return [], None
+    finally:
+        if close_conn:
+            release_db_connection(conn)
 
 def init_db():
     """Initializes the database and creates the users table if it doesn't exist."""
@@ -34,6 +320,9 @@ def init_db():
     try:
         conn = get_db_connection()
         cur = conn.cursor()
+
+        # readers keep going while a write is in progress
+        cur.execute("PRAGMA journal_mode = WAL")
         
         # --- 1. users Table ---
         # user_id INTEGER PRIMARY KEY AUTOINCREMENT is the standard
@@ -126,6 +415,52 @@ def init_db():
                 FOREIGN KEY (sender_user_id) REFERENCES users (user_id) ON DELETE CASCADE,
                 FOREIGN KEY (recipient_user_id) REFERENCES users (user_id) ON DELETE SET NULL
             )""")
+
+        # conversation_key (see conversation_key()) was added later; fill it in for older rows
+        columns = [row[1] for row in cur.execute("PRAGMA table_info(messages)")]
+        if "conversation_key" not in columns:
+            cur.execute("ALTER TABLE messages ADD COLUMN conversation_key INTEGER")
+            cur.execute(f"""
+                UPDATE messages
+                SET conversation_key = min(sender_user_id, recipient_user_id) * {CONVERSATION_KEY_SHIFT}
+                                       + max(sender_user_id, recipient_user_id)
+                WHERE recipient_user_id IS NOT NULL AND is_group_message = 0
+            """)
+            print(f"[DB INFO] Added conversation keys to {cur.rowcount} messages.")
+        # group messages name their group (recipient_user_id stays NULL)
+        if "group_id" not in columns:
+            cur.execute("ALTER TABLE messages ADD COLUMN group_id INTEGER REFERENCES groups (group_id) ON DELETE CASCADE")
+        # 0 while a private message waits for its offline recipient; older rows count as delivered
+        if "delivered" not in columns:
+            cur.execute("ALTER TABLE messages ADD COLUMN delivered INTEGER NOT NULL DEFAULT 1")
+
+        # --- 11. delivery_cursors: per user and conversation, the last message
+        # pushed to them and the last one they have read
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS delivery_cursors (
+            user_id INTEGER NOT NULL,
+            peer_user_id INTEGER NOT NULL,
+            last_delivered_id INTEGER NOT NULL DEFAULT 0,
+            last_read_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, peer_user_id),
+            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE,
+            FOREIGN KEY (peer_user_id) REFERENCES users (user_id) ON DELETE CASCADE
+        )""")
+
+        # --- 9. indexes
+        # a conversation's rows sit together in message_id (rowid) order
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_key)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_group ON messages (group_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_user_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_recipient ON messages (recipient_user_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members (user_id)")
+        # only the few waiting messages are in it
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_messages_undelivered
+            ON messages (recipient_user_id) WHERE delivered = 0""")
+
+        # --- 10. full-text search over messages.text
+        _init_message_search(cur)
             
         # Add initial admin user if not exists
         if not get_user_by_username(ADMIN_USERNAME, conn):
@@ -134,11 +469,14 @@ def init_db():
             print(f"[DB] Default admin user '{ADMIN_USERNAME}' created with password '{ADMIN_PASSWORD}'.")
             
         conn.commit()
+        _load_identity_cache(conn)
+        _load_membership_index(conn)
+        _load_message_ids(conn)
     except Exception as e:
         print(f"[DB ERROR] Initialization failed: {e}")
     finally:
         if conn:
-            conn.close()
+            release_db_connection(conn)
 
 
 def add_user_db(username, password_hash, role, conn=None):
@@ -152,6 +490,8 @@ def add_user_db(username, password_hash, role, conn=None):
         cur.execute("INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)", 
                     (username, password_hash, role))
         conn.commit()
+        _remember_user(username, cur.lastrowid)
+        _notify("user_added", username=username)
         return True
     except sqlite3.IntegrityError:
         print(f"[DB ERROR] User {username} already exists.")
@@ -161,7 +501,7 @@ def add_user_db(username, password_hash, role, conn=None):
         return False
     finally:
         if close_conn:
-            conn.close()
+            release_db_connection(conn)
 
 def get_user_by_username(username, conn=None):
     """Fetches user data by username: (username, password_hash, role)"""
@@ -178,7 +518,7 @@ def get_user_by_username(username, conn=None):
         return None
     finally:
         if close_conn:
-            conn.close()
+            release_db_connection(conn)
 
 def get_all_users_db(conn=None):
     """Fetches all usernames from the database."""
@@ -195,7 +535,7 @@ def get_all_users_db(conn=None):
         return []
     finally:
         if close_conn:
-            conn.close()
+            release_db_connection(conn)
 
 def remove_user_db(username, conn=None):
     """Removes a user from the database."""
@@ -207,17 +547,27 @@ def remove_user_db(username, conn=None):
         cur = conn.cursor()
         cur.execute("DELETE FROM users WHERE username = ?", (username,))
         conn.commit()
-        return cur.rowcount > 0 
+        if cur.rowcount > 0:
+            user_id = _user_ids.get(username)
+            _forget_user(username)
+            if user_id is not None:
+                _unindex_user(user_id)
+            _notify("user_removed", username=username)
+            return True
+        return False
     except Exception as e:
         print(f"[DB ERROR] Remove user failed: {e}")
         return False
     finally:
         if close_conn:
-            conn.close()
+            release_db_connection(conn)
 
 
 def get_user_id_by_username(username, conn=None):
-    """Fetches user ID by username."""
+    """Fetches user ID by username, from the identity cache when it is there."""
+    user_id = _user_ids.get(username)
+    if user_id is not None:
+        return user_id
     close_conn = False
     if conn is None:
         conn = get_db_connection()
@@ -226,52 +576,268 @@ def get_user_id_by_username(username, conn=None):
         cur = conn.cursor()
         cur.execute("SELECT user_id FROM users WHERE username = ?", (username,))
         result = cur.fetchone()
+        if result:
+            _remember_user(username, result[0])
         return result[0] if result else None
     except Exception as e:
         print(f"[DB ERROR] Fetch user ID failed: {e}")
         return None
     finally:
         if close_conn:
-            conn.close()
-
+            release_db_connection(conn)
 
-def add_message_db(sender_username, recipient_username, text, is_group=False, conn=None):
-    """Logs a new message (public or private) to the database."""
+def get_username_by_id(user_id, conn=None):
+    """Fetches a username by user ID, from the identity cache when it is there."""
+    username = _usernames.get(user_id)
+    if username is not None:
+        return username
     close_conn = False
     if conn is None:
         conn = get_db_connection()
         close_conn = True
     try:
         cur = conn.cursor()
-        
-        # Get user IDs
-        sender_id = get_user_id_by_username(sender_username, conn)
-        recipient_id = get_user_id_by_username(recipient_username, conn) if recipient_username else None
-        
+        cur.execute("SELECT username FROM users WHERE user_id = ?", (user_id,))
+        result = cur.fetchone()
+        if result:
+            _remember_user(result[0], user_id)
+        return result[0] if result else None
+    except Exception as e:
+        print(f"[DB ERROR] Fetch username failed: {e}")
+        return None
+    finally:
+        if close_conn:
+            release_db_connection(conn)
+
+
+# Private messages between two users share one integer key, whichever way they go.
+CONVERSATION_KEY_SHIFT = 2 ** 32
+
+def conversation_key(user1_id, user2_id):
+    """Returns the key of the private conversation between two user ids."""
+    return min(user1_id, user2_id) * CONVERSATION_KEY_SHIFT + max(user1_id, user2_id)
+
+# One statement for every message; sqlite3 keeps it prepared, so a batch is
+# a single executemany with no per-row parsing.
+INSERT_MESSAGE_SQL = """
+    INSERT INTO messages (message_id, sender_user_id, recipient_user_id, text, sent_at, is_group_message, conversation_key, group_id, delivered)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+# (user_id, peer_user_id, message_id): user has received peer's messages up to message_id
+UPSERT_DELIVERED_SQL = """
+    INSERT INTO delivery_cursors (user_id, peer_user_id, last_delivered_id) VALUES (?, ?, ?)
+    ON CONFLICT (user_id, peer_user_id)
+    DO UPDATE SET last_delivered_id = max(last_delivered_id, excluded.last_delivered_id)
+"""
+
+# Message ids are handed out here rather than by SQLite, so a message has its
+# id as soon as it is sent, even while it waits for the batched writer.
+_next_message_id = None
+_message_id_lock = threading.Lock()
+
+def _load_message_ids(conn):
+    global _next_message_id
+    last_id = conn.execute("SELECT coalesce(max(message_id), 0) FROM messages").fetchone()[0]
+    # AUTOINCREMENT never reuses ids of deleted rows either
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+    with _message_id_lock:
+        _next_message_id = max(last_id, row[0] if row else 0) + 1
+
+def new_message_id(conn=None):
+    """Reserves an id for a message about to be stored."""
+    global _next_message_id
+    if _next_message_id is None:
+        if conn is not None:
+            _load_message_ids(conn)
+        else:
+            conn = get_db_connection()
+            try:
+                _load_message_ids(conn)
+            finally:
+                release_db_connection(conn)
+    with _message_id_lock:
+        message_id = _next_message_id
+        _next_message_id += 1
+        return message_id
+
+def _insert_messages(cur, messages):
+    """INSERTs (sender_username, recipient_username, text, is_group, sent_at[, group_name[, delivered[, message_id]]])
+    rows without committing. Returns how many were stored.
+
+    Delivered private messages also move the recipient's delivery cursor.
+    """
+    rows = []
+    cursors = {}  # {(recipient_id, sender_id): last delivered message_id}
+    for message in messages:
+        sender_username, recipient_username, text, is_group, sent_at = message[:5]
+        group_name = message[5] if len(message) > 5 else None
+        delivered = message[6] if len(message) > 6 else True
+        message_id = message[7] if len(message) > 7 else None
+        if message_id is None:
+            message_id = new_message_id(cur.connection)
+        # user IDs come from the identity cache
+        sender_id = get_user_id_by_username(sender_username, cur.connection)
+        recipient_id = get_user_id_by_username(recipient_username, cur.connection) if recipient_username else None
+        group_id = get_group_id_by_name(group_name, cur.connection) if group_name else None
         if sender_id is None:
             print(f"[DB ERROR] Sender '{sender_username}' not found.")
-            return False
-
+            continue
         # If it's a private message, ensure recipient is valid (unless public)
         if recipient_username and recipient_id is None:
-             print(f"[DB ERROR] Recipient '{recipient_username}' not found.")
-             return False
+            print(f"[DB ERROR] Recipient '{recipient_username}' not found.")
+            continue
+        if group_name and group_id is None:
+            print(f"[DB ERROR] Group '{group_name}' not found.")
+            continue
+        key = conversation_key(sender_id, recipient_id) if recipient_id is not None and not is_group else None
+        rows.append((message_id, sender_id, recipient_id, text, sent_at, 1 if is_group else 0, key, group_id, 1 if delivered else 0))
+        if key is not None and delivered:
+            cursors[recipient_id, sender_id] = max(cursors.get((recipient_id, sender_id), 0), message_id)
+    cur.executemany(INSERT_MESSAGE_SQL, rows)
+    cur.executemany(UPSERT_DELIVERED_SQL, [(user_id, peer_id, message_id) for (user_id, peer_id), message_id in cursors.items()])
+    return len(rows)
 
-        current_time = int(time.time()) # time.time() is used for INTEGER timestamps
-        
-        cur.execute("""
-            INSERT INTO messages (sender_user_id, recipient_user_id, text, sent_at, is_group_message)
-            VALUES (?, ?, ?, ?, ?)
-        """, (sender_id, recipient_id, text, current_time, 1 if is_group else 0))
-        
+def add_messages_db(messages, conn=None):
+    """Stores many (sender_username, recipient_username, text, is_group, sent_at[, group_name[, delivered[, message_id]]])
+    messages in one transaction. Returns how many were stored."""
+    close_conn = False
+    if conn is None:
+        conn = get_db_connection()
+        close_conn = True
+    try:
+        stored = _insert_messages(conn.cursor(), messages)
         conn.commit()
-        return True
+        return stored
     except Exception as e:
-        print(f"[DB ERROR] Add message failed: {e}")
-        return False
+        print(f"[DB ERROR] Add messages failed: {e}")
+        return 0
     finally:
         if close_conn:
-            conn.close()
+            release_db_connection(conn)
+
+def add_message_db(sender_username, recipient_username, text, is_group=False, group_name=None,
+                   delivered=True, message_id=None, conn=None):
+    """Logs a new message (public, private or to group_name) to the database.
+
+    Returns its message_id (reserved with new_message_id if not given), or
+    None if it could not be stored.
+    delivered=False marks a private message its recipient has not received;
+    get_undelivered_messages_db hands it out later.
+    With "batched" durability and no conn, the message is only queued for the
+    writer thread; it is committed within a few milliseconds.
+    """
+    if message_id is None:
+        message_id = new_message_id(conn)
+    current_time = int(time.time()) # time.time() is used for INTEGER timestamps
+    message = (sender_username, recipient_username, text, is_group, current_time, group_name, delivered, message_id)
+    if conn is None and DB_DURABILITY == "batched":
+        _get_message_writer().add(message)
+        return message_id
+    return message_id if add_messages_db([message], conn) == 1 else None
+
+# =========================
+# Message writer
+# =========================
+MESSAGE_FLUSH_INTERVAL = 0.005  # seconds a batch stays open for more messages
+MESSAGE_BATCH_SIZE = 1000
+
+class _Delivered:
+    """Writer queue item: messages ({"message_id", "sender"} dicts) that reached username."""
+    def __init__(self, username, messages):
+        self.username = username
+        self.messages = messages
+
+class MessageWriter:
+    """Commits queued messages in batches from one thread with its own connection.
+
+    Queue items are message tuples, _Delivered marks or threading.Events; a
+    mark is applied after the messages queued before it are stored, and an
+    Event is set once everything queued before it is committed.
+    """
+    def __init__(self, flush_interval=MESSAGE_FLUSH_INTERVAL, batch_size=MESSAGE_BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def add(self, message):
+        self.queue.put(message)
+
+    def flush(self, timeout=None):
+        """Waits until everything queued so far is committed."""
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def _run(self):
+        conn = _connect()
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # a flush closes the batch early; nothing waits on the rest
+            while len(batch) < self.batch_size and not isinstance(batch[-1], threading.Event):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._commit(conn, batch)
+
+    def _commit(self, conn, batch):
+        messages = [item for item in batch if isinstance(item, tuple)]
+        deliveries = [item for item in batch if isinstance(item, _Delivered)]
+        try:
+            self._insert(conn, messages)
+        except Exception as e:
+            print(f"[DB ERROR] Message batch of {len(messages)} failed, retrying one by one: {e}")
+            for message in messages:
+                try:
+                    self._insert(conn, [message])
+                except Exception as e:
+                    print(f"[DB ERROR] Add message failed: {e}")
+        if deliveries:
+            try:
+                cur = conn.cursor()
+                for delivery in deliveries:
+                    _mark_delivered(cur, delivery.username, delivery.messages)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"[DB ERROR] Marking {len(deliveries)} deliveries failed: {e}")
+        for item in batch:
+            if isinstance(item, threading.Event):
+                item.set()
+
+    def _insert(self, conn, messages):
+        if not messages:
+            return
+        try:
+            _insert_messages(conn.cursor(), messages)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+_message_writer = None
+_message_writer_lock = threading.Lock()
+
+def _get_message_writer():
+    global _message_writer
+    with _message_writer_lock:
+        if _message_writer is None:
+            _message_writer = MessageWriter()
+        return _message_writer
+
+def flush_messages(timeout=None):
+    """Waits until every message queued by add_message_db is committed."""
+    if _message_writer is not None:
+        _message_writer.flush(timeout)
+
+# the writer is a daemon thread; don't exit with messages still queued
+atexit.register(flush_messages, DB_BUSY_TIMEOUT)
 
 # models.py (Add this function)
 
@@ -280,6 +846,8 @@ def get_historical_messages_db(user1_username, user2_username, conn=None):
     Fetches all private messages exchanged between two specific users, 
     ordered by time.
     """
+    # include messages still waiting in the writer queue
+    flush_messages()
     close_conn = False
     if conn is None:
         conn = get_db_connection()
@@ -296,23 +864,17 @@ def get_historical_messages_db(user1_username, user2_username, conn=None):
             print("[DB ERROR] One or both users not found for message history.")
             return []
 
-        # SQL query to select messages where:
-        # 1. Sender is user1 AND Recipient is user2
-        # OR
-        # 2. Sender is user2 AND Recipient is user1
-        # The result is ordered by sent_at time.
+        # Both directions of the conversation share one conversation_key, so
+        # this is a single index range, already in message_id (= sending) order.
         cur.execute(f"""
             SELECT T1.username AS sender, T3.username AS recipient, T2.text, T2.sent_at 
             FROM messages T2
             JOIN users T1 ON T2.sender_user_id = T1.user_id
             JOIN users T3 ON T2.recipient_user_id = T3.user_id
-            WHERE (
-                (T2.sender_user_id = ? AND T2.recipient_user_id = ?) OR
-                (T2.sender_user_id = ? AND T2.recipient_user_id = ?)
-            )
+            WHERE T2.conversation_key = ?
             AND T2.is_group_message = 0 
-            ORDER BY T2.sent_at ASC
-        """, (user1_id, user2_id, user2_id, user1_id))
+            ORDER BY T2.message_id ASC
+        """, (conversation_key(user1_id, user2_id),))
         
         # Fetch results and format them
         messages = []
@@ -331,7 +893,255 @@ def get_historical_messages_db(user1_username, user2_username, conn=None):
         return []
     finally:
         if close_conn:
-            conn.close()
+            release_db_connection(conn)
+
+def get_history_page_db(user1_username, user2_username, limit, before_message_id=None, conn=None):
+    """
+    Fetches the newest `limit` private messages between two users that are
+    older than `before_message_id` (or the newest overall), oldest first.
+    Returns (messages, cursor); cursor is the before_message_id for the next,
+    older page, or None if there is none.
+    """
+    flush_messages()
+    close_conn = False
+    if conn is None:
+        conn = get_db_connection()
+        close_conn = True
+        
+    try:
+        cur = conn.cursor()
+        
+        user1_id = get_user_id_by_username(user1_username, conn)
+        user2_id = get_user_id_by_username(user2_username, conn)
+        
+        if user1_id is None or user2_id is None:
+            print("[DB ERROR] One or both users not found for message history.")
+            return [], None
+
+        # keyset paging: walk the conversation index backwards from the cursor,
+        # reading one row more than asked to learn whether an older page exists
+        cur.execute("""
+            SELECT T2.message_id, T1.username AS sender, T3.username AS recipient, T2.text, T2.sent_at 
+            FROM messages T2
+            JOIN users T1 ON T2.sender_user_id = T1.user_id
+            JOIN users T3 ON T2.recipient_user_id = T3.user_id
+            WHERE T2.conversation_key = ?
+            AND T2.is_group_message = 0 
+            AND T2.message_id < ?
+            ORDER BY T2.message_id DESC
+            LIMIT ?
+        """, (conversation_key(user1_id, user2_id),
+              before_message_id if before_message_id is not None else 2 ** 63 - 1,
+              limit + 1))
+        rows = cur.fetchall()
+
+        cursor = rows[limit - 1][0] if len(rows) > limit else None
+        messages = []
+        for row in reversed(rows[:limit]):
+            messages.append({
+                "message_id": row[0],
+                "sender": row[1],
+                "recipient": row[2],
+                "text": row[3],
+                "sent_at": row[4] # Unix timestamp
+            })
+            
+        return messages, cursor
+    
+    except Exception as e:
+        print(f"[DB ERROR] Fetch history page failed: {e}")
+        return [], None
+    finally:
+        if close_conn:
+            release_db_connection(conn)
+
+def get_group_history_page_db(group_name, limit, before_message_id=None, conn=None):
+    """
+    Fetches the newest `limit` messages sent to a group that are older than
+    `before_message_id`, oldest first. Returns (messages, cursor) like
+    get_history_page_db.
+    """
+    flush_messages()
+    close_conn = False
+    if conn is None:
+        conn = get_db_connection()
+        close_conn = True
+        
+    try:
+        cur = conn.cursor()
+        group_id = get_group_id_by_name(group_name, conn)
+        if group_id is None:
+            print(f"[DB ERROR] Group '{group_name}' not found.")
+            return [], None
+
+        cur.execute("""
+            SELECT T2.message_id, T1.username AS sender, T2.text, T2.sent_at 
+            FROM messages T2
+            JOIN users T1 ON T2.sender_user_id = T1.user_id
+            WHERE T2.group_id = ?
+            AND T2.message_id < ?
+            ORDER BY T2.message_id DESC
+            LIMIT ?
+        """, (group_id,
+              before_message_id if before_message_id is not None else 2 ** 63 - 1,
+              limit + 1))
+        rows = cur.fetchall()
+
+        cursor = rows[limit - 1][0] if len(rows) > limit else None
+        messages = []
+        for row in reversed(rows[:limit]):
+            messages.append({
+                "message_id": row[0],
+                "sender": row[1],
+                "group": group_name,
+                "text": row[2],
+                "sent_at": row[3] # Unix timestamp
+            })
+            
+        return messages, cursor
+    
+    except Exception as e:
+        print(f"[DB ERROR] Fetch group history failed: {e}")
+        return [], None
+    finally:
+        if close_conn:
+            release_db_connection(conn)
+
+def get_undelivered_messages_db(username, limit, after_message_id=0, conn=None):
+    """
+    Fetches up to `limit` private messages after `after_message_id` that
+    reached the server while `username` was offline, oldest first. They stay
+    undelivered until mark_delivered_db is called for them.
+    """
+    flush_messages()
+    close_conn = False
+    if conn is None:
+        conn = get_db_connection()
+        close_conn = True
+        
+    try:
+        cur = conn.cursor()
+        user_id = get_user_id_by_username(username, conn)
+        if user_id is None:
+            return []
+
+        # messages from users deleted since are left out
+        cur.execute("""
+            SELECT T2.message_id, T1.username AS sender, T2.text, T2.sent_at
+            FROM messages T2
+            JOIN users T1 ON T2.sender_user_id = T1.user_id
+            WHERE T2.recipient_user_id = ? AND T2.delivered = 0 AND T2.message_id > ?
+            ORDER BY T2.message_id ASC
+            LIMIT ?
+        """, (user_id, after_message_id, limit))
+
+        messages = []
+        for message_id, sender, text, sent_at in cur.fetchall():
+            messages.append({
+                "message_id": message_id,
+                "sender": sender,
+                "text": text,
+                "sent_at": sent_at # Unix timestamp
+            })
+        return messages
+
+    except Exception as e:
+        print(f"[DB ERROR] Fetch undelivered messages failed: {e}")
+        return []
+    finally:
+        if close_conn:
+            release_db_connection(conn)
+
+def _mark_delivered(cur, username, messages):
+    user_id = get_user_id_by_username(username, cur.connection)
+    last_ids = {}
+    for msg in messages:
+        last_ids[msg["sender"]] = max(last_ids.get(msg["sender"], 0), msg["message_id"])
+    cur.executemany("UPDATE messages SET delivered = 1 WHERE message_id = ?",
+                    [(msg["message_id"],) for msg in messages])
+    cursors = []
+    for sender, message_id in last_ids.items():
+        sender_id = get_user_id_by_username(sender, cur.connection) if sender else None
+        # a sender deleted since has no cursor left to move
+        if sender_id is not None:
+            cursors.append((user_id, sender_id, message_id))
+    cur.executemany(UPSERT_DELIVERED_SQL, cursors)
+
+def mark_delivered_db(username, messages, conn=None):
+    """Marks messages ({"message_id", "sender"} dicts) delivered to username and moves
+    username's delivery cursors past them.
+
+    With "batched" durability and no conn, the change is queued for the writer
+    thread, behind any of those messages it has not stored yet.
+    """
+    if conn is None and DB_DURABILITY == "batched":
+        _get_message_writer().add(_Delivered(username, messages))
+        return True
+    close_conn = False
+    if conn is None:
+        conn = get_db_connection()
+        close_conn = True
+    try:
+        _mark_delivered(conn.cursor(), username, messages)
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"[DB ERROR] Mark delivered failed: {e}")
+        return False
+    finally:
+        if close_conn:
+            release_db_connection(conn)
+
+def mark_read_db(username, peer_username, message_id, conn=None):
+    """Moves the read cursor of username's conversation with peer_username up to message_id."""
+    close_conn = False
+    if conn is None:
+        conn = get_db_connection()
+        close_conn = True
+    try:
+        user_id = get_user_id_by_username(username, conn)
+        peer_id = get_user_id_by_username(peer_username, conn)
+        if user_id is None or peer_id is None:
+            print("[DB ERROR] One or both users not found for read cursor.")
+            return False
+        conn.execute("""
+            INSERT INTO delivery_cursors (user_id, peer_user_id, last_read_id) VALUES (?, ?, ?)
+            ON CONFLICT (user_id, peer_user_id)
+            DO UPDATE SET last_read_id = max(last_read_id, excluded.last_read_id)
+        """, (user_id, peer_id, message_id))
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"[DB ERROR] Mark read failed: {e}")
+        return False
+    finally:
+        if close_conn:
+            release_db_connection(conn)
+
+def get_delivery_cursors_db(username, conn=None):
+    """Fetches {peer username: {"delivered": message_id, "read": message_id}} for a user."""
+    close_conn = False
+    if conn is None:
+        conn = get_db_connection()
+        close_conn = True
+    try:
+        user_id = get_user_id_by_username(username, conn)
+        rows = conn.execute("""
+            SELECT peer_user_id, last_delivered_id, last_read_id
+            FROM delivery_cursors WHERE user_id = ?
+        """, (user_id,)).fetchall()
+        cursors = {}
+        for peer_id, delivered, read in rows:
+            peer = get_username_by_id(peer_id, conn)
+            if peer is not None:
+                cursors[peer] = {"delivered": delivered, "read": read}
+        return cursors
+    except Exception as e:
+        print(f"[DB ERROR] Fetch delivery cursors failed: {e}")
+        return {}
+    finally:
+        if close_conn:
+            release_db_connection(conn)
 
 def add_group_db(group_name, conn=None):
     """Adds a new group to the database."""
@@ -343,6 +1153,8 @@ def add_group_db(group_name, conn=None):
         cur = conn.cursor()
         cur.execute("INSERT INTO groups (name) VALUES (?)", (group_name,))
         conn.commit()
+        _index_group(group_name, cur.lastrowid)
+        _notify("group_added", group_name=group_name)
         return True
     except sqlite3.IntegrityError:
         print(f"[DB ERROR] Group '{group_name}' already exists.")
@@ -352,7 +1164,7 @@ def add_group_db(group_name, conn=None):
         return False
     finally:
         if close_conn:
-            conn.close()
+            release_db_connection(conn)
 
 def get_all_groups_db(conn=None):
     """Fetches the names of all groups from the database."""
@@ -371,10 +1183,13 @@ def get_all_groups_db(conn=None):
         return []
     finally:
         if close_conn:
-            conn.close()
+            release_db_connection(conn)
 
 def get_group_id_by_name(group_name, conn=None):
-    """Fetches group ID by group name."""
+    """Fetches group ID by group name, from the membership index once it is loaded."""
+    if _membership_loaded:
+        with _membership_lock:
+            return _group_ids.get(group_name)
     close_conn = False
     if conn is None:
         conn = get_db_connection()
@@ -389,7 +1204,7 @@ def get_group_id_by_name(group_name, conn=None):
         return None
     finally:
         if close_conn:
-            conn.close()
+            release_db_connection(conn)
 
             
 def add_user_to_group_db(username, group_name, conn=None):
@@ -419,7 +1234,9 @@ def add_user_to_group_db(username, group_name, conn=None):
         """, (group_id, user_id))
         
         conn.commit()
+        _index_membership(user_id, group_id, True)
         print(f"[DB] User '{username}' added to group '{group_name}'.")
+        _notify("member_added", username=username, group_name=group_name)
         return True
     except sqlite3.IntegrityError:
         print(f"[DB ERROR] User '{username}' is already a member of group '{group_name}'.")
@@ -429,7 +1246,7 @@ def add_user_to_group_db(username, group_name, conn=None):
         return False
     finally:
         if close_conn:
-            conn.close()
+            release_db_connection(conn)
 
 def remove_user_from_group_db(username, group_name, conn=None):
     """Removes a user from a specific group."""
@@ -461,7 +1278,9 @@ def remove_user_from_group_db(username, group_name, conn=None):
         conn.commit()
         
         if row_count > 0:
+            _index_membership(user_id, group_id, False)
             print(f"[DB] User '{username}' removed from group '{group_name}'.")
+            _notify("member_removed", username=username, group_name=group_name)
             return True
         else:
             print(f"[DB] User '{username}' was not a member of group '{group_name}' or already removed.")
@@ -472,13 +1291,23 @@ def remove_user_from_group_db(username, group_name, conn=None):
         return False
     finally:
         if close_conn:
-            conn.close()
+            release_db_connection(conn)
 
 def get_group_members_db(group_name, conn=None):
     """
     Fetches the usernames of all members in a specific group 
-    by joining the 'users', 'groups', and 'group_members' tables.
+    by joining the 'users', 'groups', and 'group_members' tables
+    (or from the membership index once it is loaded).
     """
+    if _membership_loaded:
+        with _membership_lock:
+            group_id = _group_ids.get(group_name)
+            member_ids = list(_members_by_group.get(group_id, ()))
+        if group_id is None:
+            print(f"[DB INFO] Group '{group_name}' not found.")
+        names = (_usernames.get(user_id) for user_id in member_ids)
+        return sorted(name for name in names if name is not None)
+
     close_conn = False
     if conn is None:
         conn = get_db_connection()
@@ -514,15 +1343,22 @@ def get_group_members_db(group_name, conn=None):
         return []
     finally:
         if close_conn:
-            conn.close()
+            release_db_connection(conn)
 
 
 
 def get_user_groups_db(username, conn=None):
     """
     Fetches the names of all groups a specific user is a member of 
-    by joining the 'users', 'groups', and 'group_members' tables.
+    by joining the 'users', 'groups', and 'group_members' tables
+    (or from the membership index once it is loaded).
     """
+    if _membership_loaded:
+        user_id = _user_ids.get(username)
+        with _membership_lock:
+            names = [_group_names.get(group_id) for group_id in _groups_by_user.get(user_id, ())]
+        return sorted(name for name in names if name is not None)
+
     close_conn = False
     if conn is None:
         conn = get_db_connection()
@@ -561,4 +1397,106 @@ def get_user_groups_db(username, conn=None):
         return []
     finally:
         if close_conn:
-            conn.close()
\ No newline at end of file
+            release_db_connection(conn)
+
+# =========================
+# Files
+# =========================
+# Uploaded content is stored once, named by its SHA-256 (saved_name); every
+# user who uploaded that content is linked to it through user_files.
+
+def add_file_db(filename, uploader_username, filesize, saved_name, conn=None):
+    """
+    Records an upload stored under saved_name and links the uploader to it.
+    Content that is already known keeps its original row and name.
+    Returns the file_id, or None on failure.
+    """
+    close_conn = False
+    if conn is None:
+        conn = get_db_connection()
+        close_conn = True
+    try:
+        cur = conn.cursor()
+
+        uploader_id = get_user_id_by_username(uploader_username, conn)
+        if uploader_id is None:
+            # files.uploader_user_id is NOT NULL; unknown uploaders are filed under the admin
+            print(f"[DB INFO] Uploader '{uploader_username}' not found, recording file under '{ADMIN_USERNAME}'.")
+            uploader_id = get_user_id_by_username(ADMIN_USERNAME, conn)
+
+        cur.execute("""
+            INSERT OR IGNORE INTO files (filename, uploader_user_id, filesize, saved_name, uploaded_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (filename, uploader_id, filesize, saved_name, int(time.time())))
+        cur.execute("SELECT file_id FROM files WHERE saved_name = ?", (saved_name,))
+        file_id = cur.fetchone()[0]
+        cur.execute("INSERT OR IGNORE INTO user_files (file_id, user_id) VALUES (?, ?)", (file_id, uploader_id))
+
+        conn.commit()
+        return file_id
+    except Exception as e:
+        print(f"[DB ERROR] Add file failed: {e}")
+        return None
+    finally:
+        if close_conn:
+            release_db_connection(conn)
+
+def _file_row_to_dict(row):
+    return {"file_id": row[0], "filename": row[1], "filesize": row[2], "saved_name": row[3]}
+
+def get_all_files_db(conn=None):
+    """Fetches every stored file as a dict, oldest first."""
+    close_conn = False
+    if conn is None:
+        conn = get_db_connection()
+        close_conn = True
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT file_id, filename, filesize, saved_name FROM files ORDER BY file_id ASC")
+        return [_file_row_to_dict(row) for row in cur.fetchall()]
+    except Exception as e:
+        print(f"[DB ERROR] Fetch all files failed: {e}")
+        return []
+    finally:
+        if close_conn:
+            release_db_connection(conn)
+
+def get_file_by_id_db(file_id, conn=None):
+    """Fetches one file by id, or None."""
+    close_conn = False
+    if conn is None:
+        conn = get_db_connection()
+        close_conn = True
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT file_id, filename, filesize, saved_name FROM files WHERE file_id = ?", (file_id,))
+        row = cur.fetchone()
+        return _file_row_to_dict(row) if row else None
+    except Exception as e:
+        print(f"[DB ERROR] Fetch file failed: {e}")
+        return None
+    finally:
+        if close_conn:
+            release_db_connection(conn)
+
+def get_file_by_name_db(filename, conn=None):
+    """Fetches the most recently stored file with this name, or None."""
+    close_conn = False
+    if conn is None:
+        conn = get_db_connection()
+        close_conn = True
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT file_id, filename, filesize, saved_name FROM files
+            WHERE filename = ?
+            ORDER BY file_id DESC LIMIT 1
+        """, (filename,))
+        row = cur.fetchone()
+        return _file_row_to_dict(row) if row else None
+    except Exception as e:
+        print(f"[DB ERROR] Fetch file failed: {e}")
+        return None
+    finally:
+        if close_conn:
+            release_db_connection(conn)
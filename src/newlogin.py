@@ -1,8 +1,8 @@
 import flet as ft
 import models
 import socket
-import json 
 from screeninfo import get_monitors
+from protocol import FrameReader, send_control
 
 HOST = "127.0.0.1"
 # HOST = "192.168.43.213"
@@ -12,29 +12,6 @@ user_admin = {
     "password" : "admin"
 }
 
-def send_control(sock, data: dict):
-    """Send a JSON control message with a fixed header length"""
-    j = json.dumps(data).encode('utf-8')
-    header = f"{len(j):010d}".encode('utf-8')
-    sock.sendall(header + j)
-
-def recv_all(sock, n):
-    """Receive exactly n bytes"""
-    buf = bytearray()
-    while len(buf) < n:
-        chunk = sock.recv(n - len(buf))
-        if not chunk:
-            raise ConnectionError("Connection closed")
-        buf.extend(chunk)
-    return bytes(buf)
-
-def recv_control(sock):
-    """Receive a JSON control message"""
-    header = recv_all(sock, 10)
-    length = int(header.decode('utf-8'))
-    j = recv_all(sock, length)
-    return json.loads(j.decode('utf-8'))
-
 def login_view(page):
     width, height = get_monitor_info()
     """Creates the login screen View."""
@@ -82,7 +59,7 @@ def login_view(page):
             send_control(login_client_socket, login_request)
 
             # 4. دریافت پاسخ از سرور
-            response = recv_control(login_client_socket)
+            response = FrameReader(login_client_socket).recv_control()
             msg = response["text"]
             # 5. پردازش پاسخ
             if response.get("type") == "LOGIN_SUCCESS":
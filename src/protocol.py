@@ -0,0 +1,552 @@
+# protocol.py
+import hashlib
+import json
+import socket
+import struct
+import threading
+import zlib
+
+# v1: every frame is a 10-digit ASCII body length followed by a UTF-8 JSON body.
+# v2: a 4-byte big-endian length, then a one-byte message type code and a
+#     compact binary (MessagePack) body. Clients ask for v2 in HELLO.
+#     If zlib was also agreed in HELLO, large bodies are compressed and the
+#     high bit of the type byte is set.
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+SUPPORTED_PROTOCOLS = (PROTOCOL_V1, PROTOCOL_V2)
+HEADER_SIZE = 10
+V2_HEADER = struct.Struct(">I")
+# seconds a client waits for HELLO_ACK before assuming a v1-only server
+HELLO_TIMEOUT = 5.0
+# refuse frames larger than this instead of trying to buffer them
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+READ_BUFFER_SIZE = 64 * 1024
+
+SUPPORTED_COMPRESSION = ("zlib",)
+COMPRESSED_FLAG = 0x80
+# smaller bodies are sent as they are: chat messages gain nothing from zlib
+COMPRESS_THRESHOLD = 1024
+COMPRESS_LEVEL = 6
+
+# v2 type codes. Append only: a code must never change meaning.
+MESSAGE_TYPES = [
+    None,  # 0: the type travels inside the body
+    "HELLO", "HELLO_ACK", "BYE", "QUIT", "ERROR", "KICKED", "SERVER_CLOSE",
+    "LOGIN_REQUEST", "LOGIN_SUCCESS", "LOGIN_FAILURE",
+    "MSG", "PMSG", "PMSG_RECV",
+    "GetAllUser", "RecAllUser", "GETALLGROUPS", "RECALLGROUPS", "GETUSERGROUPS", "RECUSERGROUPS",
+    "GET_HISTORY", "RECV_HISTORY",
+    "FILE_META", "GET_FILE", "FILE_SEND", "FILE_LIST",
+    "FILE_RESUME",
+    "GET_DATA_TOKEN", "DATA_TOKEN", "DATA_HELLO",
+    "GET_FILE_LIST", "FILE_LIST_DELTA",
+    "SUBSCRIBE", "ONLINE_USERS", "USER_JOIN", "USER_LEFT", "USER_ADDED", "USER_REMOVED",
+    "GROUP_ADDED", "GROUP_JOINED", "GROUP_LEFT",
+    "NOT_MODIFIED",
+    "SEARCH", "SEARCH_RESULTS",
+    "GMSG", "GMSG_RECV",
+    "MISSED_MESSAGES", "MARK_READ",
+]
+TYPE_CODES = {name: code for code, name in enumerate(MESSAGE_TYPES) if name}
+
+# Hot messages with exactly these keys are sent as a bare array of values,
+# so the key names never go over the wire.
+MESSAGE_FIELDS = {
+    "BYE": ("username",),
+    "QUIT": (),
+    "ERROR": ("message",),
+    "KICKED": ("message",),
+    "SERVER_CLOSE": ("message",),
+    "MSG": ("username", "text"),
+    "PMSG": ("username", "recipient", "text"),
+    "PMSG_RECV": ("username", "text"),
+    "GetAllUser": ("username",),
+    "GETALLGROUPS": ("username",),
+    "GETUSERGROUPS": ("username",),
+    "RecAllUser": ("username", "text"),
+    "RECALLGROUPS": ("username", "text"),
+    "RECUSERGROUPS": ("username", "text"),
+    "RECV_HISTORY": ("username", "text"),
+    "LOGIN_SUCCESS": ("username", "text"),
+    "LOGIN_FAILURE": ("username", "text"),
+    "GET_HISTORY": ("user1", "user2"),
+    "FILE_META": ("filename", "filesize"),
+    "GET_FILE": ("filename",),
+    "FILE_SEND": ("filename", "filesize"),
+    "FILE_LIST": ("files",),
+    "FILE_RESUME": ("filename", "offset"),
+    "GET_DATA_TOKEN": (),
+    "DATA_TOKEN": ("token", "ttl"),
+    "GET_FILE_LIST": ("version",),
+    "FILE_LIST_DELTA": ("version", "added", "removed"),
+    "SUBSCRIBE": ("topics",),
+    "ONLINE_USERS": ("users",),
+    "USER_JOIN": ("username",),
+    "USER_LEFT": ("username",),
+    "USER_ADDED": ("username",),
+    "USER_REMOVED": ("username",),
+    "GROUP_ADDED": ("group",),
+    "GROUP_JOINED": ("group",),
+    "GROUP_LEFT": ("group",),
+    "NOT_MODIFIED": ("list", "version"),
+    "SEARCH": ("query",),
+    "SEARCH_RESULTS": ("query", "results", "next_offset"),
+    "GMSG": ("username", "group", "text"),
+    "GMSG_RECV": ("username", "group", "text"),
+    "MISSED_MESSAGES": ("messages", "cursors"),
+    "MARK_READ": ("peer", "message_id"),
+}
+
+# =========================
+# Compact binary body (MessagePack subset)
+# =========================
+_pack_u8 = struct.Struct(">B").pack
+_pack_u16 = struct.Struct(">H").pack
+_pack_u32 = struct.Struct(">I").pack
+_pack_u64 = struct.Struct(">Q").pack
+_pack_i64 = struct.Struct(">q").pack
+_pack_f64 = struct.Struct(">d").pack
+
+def _pack_into(obj, out):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, str):
+        b = obj.encode('utf-8')
+        n = len(b)
+        if n < 32:
+            out.append(0xa0 | n)
+        elif n < 0x100:
+            out += b"\xd9" + _pack_u8(n)
+        elif n < 0x10000:
+            out += b"\xda" + _pack_u16(n)
+        else:
+            out += b"\xdb" + _pack_u32(n)
+        out += b
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xff)
+        elif 0 <= obj < 0x10000:
+            out += b"\xcd" + _pack_u16(obj)
+        elif 0 <= obj < 0x100000000:
+            out += b"\xce" + _pack_u32(obj)
+        elif 0 <= obj < 0x10000000000000000:
+            out += b"\xcf" + _pack_u64(obj)
+        else:
+            out += b"\xd3" + _pack_i64(obj)
+    elif isinstance(obj, float):
+        out += b"\xcb" + _pack_f64(obj)
+    elif isinstance(obj, dict):
+        n = len(obj)
+        if n < 16:
+            out.append(0x80 | n)
+        elif n < 0x10000:
+            out += b"\xde" + _pack_u16(n)
+        else:
+            out += b"\xdf" + _pack_u32(n)
+        for key, value in obj.items():
+            _pack_into(key, out)
+            _pack_into(value, out)
+    elif isinstance(obj, (list, tuple)):
+        n = len(obj)
+        if n < 16:
+            out.append(0x90 | n)
+        elif n < 0x10000:
+            out += b"\xdc" + _pack_u16(n)
+        else:
+            out += b"\xdd" + _pack_u32(n)
+        for item in obj:
+            _pack_into(item, out)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        n = len(obj)
+        if n < 0x100:
+            out += b"\xc4" + _pack_u8(n)
+        elif n < 0x10000:
+            out += b"\xc5" + _pack_u16(n)
+        else:
+            out += b"\xc6" + _pack_u32(n)
+        out += obj
+    else:
+        raise TypeError(f"Cannot pack {type(obj).__name__}")
+
+def pack(obj) -> bytes:
+    """Encodes a JSON-like value as MessagePack"""
+    out = bytearray()
+    _pack_into(obj, out)
+    return bytes(out)
+
+_unpack_from = {
+    0xcc: struct.Struct(">B"), 0xcd: struct.Struct(">H"), 0xce: struct.Struct(">I"), 0xcf: struct.Struct(">Q"),
+    0xd0: struct.Struct(">b"), 0xd1: struct.Struct(">h"), 0xd2: struct.Struct(">i"), 0xd3: struct.Struct(">q"),
+    0xca: struct.Struct(">f"), 0xcb: struct.Struct(">d"),
+}
+_length_of = {
+    0xd9: struct.Struct(">B"), 0xda: struct.Struct(">H"), 0xdb: struct.Struct(">I"),  # str
+    0xc4: struct.Struct(">B"), 0xc5: struct.Struct(">H"), 0xc6: struct.Struct(">I"),  # bin
+    0xdc: struct.Struct(">H"), 0xdd: struct.Struct(">I"),  # array
+    0xde: struct.Struct(">H"), 0xdf: struct.Struct(">I"),  # map
+}
+
+def _unpack_from_view(view, pos):
+    tag = view[pos]
+    pos += 1
+    if 0xa0 <= tag <= 0xbf:
+        end = pos + (tag & 0x1f)
+        return str(view[pos:end], 'utf-8'), end
+    if tag < 0x80:
+        return tag, pos
+    if tag >= 0xe0:
+        return tag - 0x100, pos
+    if 0x90 <= tag <= 0x9f:
+        return _unpack_array(view, pos, tag & 0x0f)
+    if 0x80 <= tag <= 0x8f:
+        return _unpack_map(view, pos, tag & 0x0f)
+    if tag == 0xc0:
+        return None, pos
+    if tag == 0xc2:
+        return False, pos
+    if tag == 0xc3:
+        return True, pos
+    fmt = _unpack_from.get(tag)
+    if fmt is not None:
+        return fmt.unpack_from(view, pos)[0], pos + fmt.size
+    fmt = _length_of.get(tag)
+    if fmt is None:
+        raise ValueError(f"Unsupported MessagePack tag 0x{tag:02x}")
+    n = fmt.unpack_from(view, pos)[0]
+    pos += fmt.size
+    if tag in (0xd9, 0xda, 0xdb):
+        return str(view[pos:pos + n], 'utf-8'), pos + n
+    if tag in (0xc4, 0xc5, 0xc6):
+        return bytes(view[pos:pos + n]), pos + n
+    if tag in (0xdc, 0xdd):
+        return _unpack_array(view, pos, n)
+    return _unpack_map(view, pos, n)
+
+def _unpack_array(view, pos, n):
+    items = []
+    for _ in range(n):
+        item, pos = _unpack_from_view(view, pos)
+        items.append(item)
+    return items, pos
+
+def _unpack_map(view, pos, n):
+    result = {}
+    for _ in range(n):
+        key, pos = _unpack_from_view(view, pos)
+        result[key], pos = _unpack_from_view(view, pos)
+    return result, pos
+
+def unpack(data):
+    """Decodes a MessagePack value from bytes or a memoryview"""
+    value, _ = _unpack_from_view(memoryview(data), 0)
+    return value
+
+# =========================
+# Encoding
+# =========================
+def encode_control(data: dict) -> bytes:
+    """Encode a JSON control message as one frame (header + body)"""
+    j = json.dumps(data).encode('utf-8')
+    header = f"{len(j):0{HEADER_SIZE}d}".encode('utf-8')
+    return header + j
+
+def decode_control(body) -> dict:
+    """Decode a frame body (bytes or memoryview) into a message"""
+    return json.loads(str(body, 'utf-8'))
+
+def encode_frame(data: dict, protocol=PROTOCOL_V1, compress=False) -> bytes:
+    """Encode a message as one frame for the given protocol version
+
+    With compress=True (v2 only) bodies over COMPRESS_THRESHOLD are zlib
+    compressed when that makes them smaller.
+    """
+    if protocol == PROTOCOL_V1:
+        return encode_control(data)
+    msg_type = data.get("type")
+    code = TYPE_CODES.get(msg_type, 0)
+    fields = MESSAGE_FIELDS.get(msg_type)
+    if fields is not None and len(data) == len(fields) + 1 and all(f in data for f in fields):
+        body = pack([data[f] for f in fields])
+    elif code:
+        body = pack({k: v for k, v in data.items() if k != "type"})
+    else:
+        body = pack(data)
+    if compress and len(body) >= COMPRESS_THRESHOLD:
+        packed = zlib.compress(body, COMPRESS_LEVEL)
+        if len(packed) < len(body):
+            body = packed
+            code |= COMPRESSED_FLAG
+    return V2_HEADER.pack(len(body) + 1) + _pack_u8(code) + body
+
+def decode_frame(body, protocol=PROTOCOL_V1) -> dict:
+    """Decode a frame body returned by FrameReader.next_frame()"""
+    if protocol == PROTOCOL_V1:
+        return decode_control(body)
+    code = body[0]
+    if code & COMPRESSED_FLAG:
+        code &= ~COMPRESSED_FLAG
+        body = memoryview(_decompress(body[1:]))
+        value, _ = _unpack_from_view(body, 0)
+    else:
+        value, _ = _unpack_from_view(body, 1)
+    if code == 0:
+        return value
+    msg_type = MESSAGE_TYPES[code]
+    if isinstance(value, list):
+        value = dict(zip(MESSAGE_FIELDS[msg_type], value))
+    value["type"] = msg_type
+    return value
+
+def _decompress(data):
+    d = zlib.decompressobj()
+    body = d.decompress(data, MAX_FRAME_SIZE)
+    if d.unconsumed_tail:
+        raise ConnectionError(f"Compressed frame expands past {MAX_FRAME_SIZE} bytes")
+    return body
+
+def send_control(sock, data: dict, protocol=PROTOCOL_V1):
+    """Send a control message with fixed header length"""
+    sock.sendall(encode_frame(data, protocol))
+
+def choose_protocol(offered):
+    """Picks the highest protocol version both sides support (v1 if the client offered none)"""
+    common = [v for v in (offered or ()) if v in SUPPORTED_PROTOCOLS]
+    return max(common) if common else PROTOCOL_V1
+
+def choose_compression(offered):
+    """Picks the first compression the client offered that we support, or None"""
+    for name in offered or ():
+        if name in SUPPORTED_COMPRESSION:
+            return name
+    return None
+
+# =========================
+# Buffered reading
+# =========================
+class FrameReader:
+    """Buffered reader for the framed protocol.
+
+    Pulls large chunks from the socket with recv_into() into one reusable
+    buffer and parses every complete frame in it through memoryview slices,
+    so a burst of small messages costs one recv instead of two per frame.
+    Without a socket it works as a parser: push bytes in with feed(). Its
+    buffer then starts empty and only grows to what the frames need, since
+    the stream feeding it (e.g. asyncio's) already buffers its own input.
+
+    Raw bytes that follow a frame (file transfers) must be read through the
+    same reader, since part of them may already be buffered.
+    """
+    def __init__(self, sock=None, bufsize=READ_BUFFER_SIZE):
+        self.sock = sock
+        self.protocol = PROTOCOL_V1
+        self.buf = bytearray(bufsize if sock is not None else 0)
+        self.view = memoryview(self.buf)
+        self.start = 0  # first unread byte
+        self.end = 0    # end of the buffered data
+        self.wanted = HEADER_SIZE  # bytes the next frame needs to be complete
+
+    def buffered(self):
+        return self.end - self.start
+
+    def _reserve(self, n):
+        """Makes room for at least n bytes from self.start onwards."""
+        pending = self.end - self.start
+        if self.start + n <= len(self.buf):
+            return
+        if n > len(self.buf):
+            new_buf = bytearray(max(n, 2 * len(self.buf)))
+            new_buf[:pending] = self.view[self.start:self.end]
+            self.buf = new_buf
+            self.view = memoryview(new_buf)
+        elif pending:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def _fill(self):
+        self._reserve(max(self.wanted, READ_BUFFER_SIZE // 2))
+        n = self.sock.recv_into(self.view[self.end:])
+        if n == 0:
+            raise ConnectionError("Connection closed")
+        self.end += n
+
+    def feed(self, data):
+        """Appends bytes received by other means (e.g. an asyncio stream)."""
+        self._reserve(self.buffered() + len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def next_frame(self):
+        """Returns the next complete frame body as a memoryview, or None if it is not all buffered yet.
+
+        The view points into the reader's buffer and is only valid until the next read.
+        """
+        header_size = HEADER_SIZE if self.protocol == PROTOCOL_V1 else V2_HEADER.size
+        available = self.end - self.start
+        if available < header_size:
+            self.wanted = header_size
+            return None
+        if self.protocol == PROTOCOL_V1:
+            length = int(str(self.view[self.start:self.start + HEADER_SIZE], 'ascii'))
+        else:
+            length = V2_HEADER.unpack_from(self.view, self.start)[0]
+        if length > MAX_FRAME_SIZE:
+            raise ConnectionError(f"Frame of {length} bytes is too large")
+        if available < header_size + length:
+            self.wanted = header_size + length
+            return None
+        body_start = self.start + header_size
+        self.start = body_start + length
+        if self.start == self.end:
+            self.start = self.end = 0
+        return self.view[body_start:body_start + length]
+
+    def next_message(self):
+        """Returns the next fully buffered message, or None."""
+        body = self.next_frame()
+        return None if body is None else decode_frame(body, self.protocol)
+
+    def frames(self):
+        """Yields every message that is already fully buffered."""
+        while (msg := self.next_message()) is not None:
+            yield msg
+
+    def recv_control(self):
+        """Receive a control message"""
+        while True:
+            msg = self.next_message()
+            if msg is not None:
+                return msg
+            self._fill()
+
+    def take(self, n):
+        """Consumes up to n already-buffered bytes and returns them as a memoryview."""
+        n = min(n, self.end - self.start)
+        chunk = self.view[self.start:self.start + n]
+        self.start += n
+        return chunk
+
+    def readinto(self, target):
+        """Reads up to len(target) raw bytes into target, buffered bytes first. Returns the count."""
+        chunk = self.take(len(target))
+        if chunk:
+            target[:len(chunk)] = chunk
+            return len(chunk)
+        count = self.sock.recv_into(target)
+        if count == 0:
+            raise ConnectionError("Connection closed")
+        return count
+
+    def recv_exact(self, n):
+        """Receive exactly n raw bytes, reading what is not buffered straight into the result"""
+        data = bytearray(n)
+        target = memoryview(data)
+        got = 0
+        while got < n:
+            got += self.readinto(target[got:])
+        return data
+
+
+# =========================
+# Files
+# =========================
+def file_sha256(filepath):
+    """Hex SHA-256 of a file's content, which is also its name in the server's file store"""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while chunk := f.read(READ_BUFFER_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def is_content_name(name):
+    return isinstance(name, str) and len(name) == 64 and all(c in "0123456789abcdef" for c in name)
+
+
+# =========================
+# Client side
+# =========================
+class Channel:
+    """A client's connection to the server: socket, FrameReader and negotiated protocol."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = FrameReader(sock)
+        self.protocol = PROTOCOL_V1
+        self.compress = False
+        # UI and polling threads send concurrently; frames must not interleave
+        self.send_lock = threading.Lock()
+
+    def hello(self, username, protocols=SUPPORTED_PROTOCOLS, compression=SUPPORTED_COMPRESSION, **extra):
+        """Introduces the client and switches to the best protocol the server accepts.
+
+        A server that predates negotiation never answers, so after HELLO_TIMEOUT
+        the channel simply stays on v1.
+        """
+        hello_msg = {"type": "HELLO", "username": username, "protocol": list(protocols), **extra}
+        if compression:
+            hello_msg["compression"] = list(compression)
+        send_control(self.sock, hello_msg)
+        self.sock.settimeout(HELLO_TIMEOUT)
+        try:
+            reply = self.reader.recv_control()
+        except socket.timeout:
+            return None
+        finally:
+            self.sock.settimeout(None)
+        if reply["type"] != "HELLO_ACK":
+            raise ConnectionError(reply.get("message", f"Unexpected {reply['type']} during HELLO"))
+        self.protocol = reply["protocol"]
+        self.compress = reply.get("compression") in SUPPORTED_COMPRESSION
+        self.reader.protocol = self.protocol
+        return reply
+
+    def send(self, data: dict):
+        frame = encode_frame(data, self.protocol, self.compress)
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+    def recv(self):
+        return self.reader.recv_control()
+
+    def sendall(self, data):
+        """Sends raw bytes (file contents) on the control socket."""
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def recv_exact(self, n):
+        return self.reader.recv_exact(n)
+
+    def open_data_channel(self, token):
+        """Opens a data connection to the same server with a DATA_TOKEN from this channel.
+
+        Like HELLO, DATA_HELLO and its HELLO_ACK are v1 frames; after that the
+        data connection speaks whatever protocol the control connection does.
+        """
+        sock = socket.create_connection(self.sock.getpeername()[:2])
+        data = Channel(sock)
+        try:
+            send_control(sock, {"type": "DATA_HELLO", "token": token})
+            reply = data.recv()
+        except (OSError, ConnectionError):
+            sock.close()
+            raise
+        if reply["type"] != "HELLO_ACK":
+            sock.close()
+            raise ConnectionError(reply.get("message", f"Unexpected {reply['type']} during DATA_HELLO"))
+        data.protocol = data.reader.protocol = reply["protocol"]
+        data.compress = reply.get("compression") in SUPPORTED_COMPRESSION
+        return data
+
+    def send_file(self, filepath, offset=0):
+        """Sends a file's bytes from offset on, with no other frame in between."""
+        with self.send_lock, open(filepath, "rb") as f:
+            self.sock.sendfile(f, offset)
+
+    def close(self):
+        self.sock.close()
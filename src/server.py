@@ -1,48 +1,467 @@
 # server.py
 import socket
 import threading
-import json
 import os
 import models 
 import time
+import tempfile
+import hashlib
+import secrets
+from collections import deque
+from protocol import (FrameReader, PROTOCOL_V1, PROTOCOL_V2, choose_compression, choose_protocol,
+                      encode_frame, file_sha256, is_content_name, send_control)
+
+# default slow-consumer limits for a connection's outbound queue
+MAX_QUEUED_FRAMES = 1024
+MAX_QUEUED_BYTES = 4 * 1024 * 1024
+# seconds a connection may stay over its limits before it is evicted
+SLOW_CONSUMER_GRACE = 10.0
+OVERFLOW_POLICIES = ("drop_oldest", "disconnect")
+# evicted usernames remembered for stats(); older ones only count in the total
+EVICTION_HISTORY = 100
+# the writer joins queued frames into one sendall up to this many bytes
+WRITE_BATCH_BYTES = 64 * 1024
+FILE_CHUNK_SIZE = 64 * 1024
+# downloads go through the kernel's sendfile where the OS has it (not on
+# Windows); otherwise they are copied through one large reusable buffer
+USE_SENDFILE = hasattr(os, "sendfile")
+FILE_SEND_BUFFER = 1024 * 1024
+# uploads larger than this are refused (and the connection dropped)
+MAX_UPLOAD_SIZE = 2 * 1024 * 1024 * 1024
+# stored files are named by the SHA-256 of their content (see models.add_file_db);
+# uploads in progress live in files_dir under this prefix until complete
+UPLOAD_TMP_PREFIX = ".upload-"
+# resumable uploads end in this suffix and survive a dropped connection for
+# PARTIAL_UPLOAD_TTL seconds
+PARTIAL_UPLOAD_SUFFIX = ".part"
+PARTIAL_UPLOAD_TTL = 24 * 60 * 60
+# seconds a data connection token stays valid after it is issued
+DATA_TOKEN_TTL = 30.0
+# file catalog changes kept for clients catching up with GET_FILE_LIST
+CATALOG_HISTORY = 256
+
+# SUBSCRIBE topics: each gets a snapshot once, then only the changes.
+#   users     RecAllUser, then USER_ADDED / USER_REMOVED
+#   presence  ONLINE_USERS, then USER_JOIN / USER_LEFT
+#   groups    RECALLGROUPS, then GROUP_ADDED
+#   my_groups RECUSERGROUPS, then GROUP_JOINED / GROUP_LEFT for this user
+SUBSCRIBE_TOPICS = ("users", "presence", "groups", "my_groups")
+
+# GetAllUser / GETALLGROUPS / GETUSERGROUPS replies carry the version of their
+# list; a request that sends back the current version gets NOT_MODIFIED.
+# Versions start from the clock so they keep rising across restarts.
+LIST_VERSION_START = int(time.time() * 1000)
+# replies that are the same for every client, by the list version they depend on
+SHARED_REPLIES = {"users": ("RecAllUser",), "groups": ("RECALLGROUPS",)}
+
+# GET_HISTORY pages are capped at this many messages
+MAX_HISTORY_PAGE = 500
+# SEARCH returns this many hits unless asked for fewer
+MAX_SEARCH_RESULTS = 50
+# missed private messages pushed on HELLO, per frame
+MAX_MISSED_MESSAGES = 1000
+
+# =========================
+# Client connections
+# =========================
+class SlowConsumerPolicy:
+    """Outbound queue limits shared by every connection, plus overflow counters.
+
+    When a queue would go over max_frames/max_bytes, "drop_oldest" discards
+    the oldest queued frames to make room and "disconnect" refuses the new
+    frame. Either way a client that stays over its limits for longer than
+    `grace` seconds is evicted.
+    """
+    def __init__(self, max_frames=MAX_QUEUED_FRAMES, max_bytes=MAX_QUEUED_BYTES,
+                 on_overflow="drop_oldest", grace=SLOW_CONSUMER_GRACE):
+        if on_overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {on_overflow}")
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.on_overflow = on_overflow
+        self.grace = grace
+        self.lock = threading.Lock()
+        self.dropped_frames = 0
+        self.evictions = 0
+        self.evicted_users = deque(maxlen=EVICTION_HISTORY)  # most recent last
+
+    def record_drop(self, count=1):
+        with self.lock:
+            self.dropped_frames += count
+
+    def record_eviction(self, username):
+        with self.lock:
+            self.evictions += 1
+            self.evicted_users.append(username)
+        print(f"[SERVER] Evicted slow consumer {username}.")
+
+    def stats(self):
+        with self.lock:
+            return {"dropped_frames": self.dropped_frames, "evictions": self.evictions,
+                    "evicted_users": list(self.evicted_users)}
+
+
+class ClientConnection:
+    """A connected client plus its bounded outbound queue.
+
+    Any thread may queue frames; only the connection's own writer touches the
+    socket, so a client with a full TCP window only ever delays itself.
+    Queue items are encoded frames (bytes) or jobs (callables) such as file
+    downloads, which the writer runs in order with the frames around them.
+    """
+    def __init__(self, sock, username, policy):
+        self.sock = sock
+        self.username = username
+        self.policy = policy
+        self.protocol = PROTOCOL_V1  # wire format negotiated at HELLO
+        self.compress = False        # zlib for large v2 frames, also negotiated
+        self.owner = None            # control connection, if this is a data connection
+        self.file_deltas = False     # asked for the catalog with GET_FILE_LIST, so gets FILE_LIST_DELTA
+        self.data_conns = set()      # data connections opened with this connection's tokens
+        self.topics = set()          # SUBSCRIBE topics whose changes are pushed to this connection
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.overflow_since = None  # when the queue first hit its limits
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def start(self):
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def send(self, frame, block=False):
+        """Queues a frame or job. Returns False once the connection is closed or evicted.
+
+        Overflow is handled by the slow-consumer policy, so a frame it drops
+        still counts as sent; a job it refuses returns False, as the caller
+        has to answer for it. With block=True the caller waits for room
+        instead (used for a client's own downloads, never for fan-out).
+        """
+        size = 0 if callable(frame) else len(frame)
+        evict = False
+        refused = False
+        with self.cond:
+            while block and not self.closed and self._over_limit(size):
+                self.cond.wait()
+            if self.closed:
+                return False
+            if self._over_limit(size):
+                queued, evict = self._overflow(size)
+                if not queued:
+                    if evict:
+                        self.closed = True
+                        self.queue.clear()
+                        self.queued_bytes = 0
+                        self.cond.notify_all()
+                    else:
+                        self.policy.record_drop()
+                    refused = callable(frame)
+                    frame = None
+            if frame is not None:
+                self.queue.append(frame)
+                self.queued_bytes += size
+                self.cond.notify_all()
+        if evict:
+            self.policy.record_eviction(self.username)
+            self._close_socket()
+            return False
+        if frame is not None:
+            self._wake_writer()
+        return not refused
+
+    def _over_limit(self, size, extra_frames=0):
+        frames = len(self.queue) + extra_frames
+        return frames >= self.policy.max_frames or (frames > 0 and self.queued_bytes + size > self.policy.max_bytes)
+
+    def _overflow(self, size):
+        """Applies the policy to a frame that does not fit. Returns (queued, evict); holds self.cond."""
+        now = time.monotonic()
+        if self.overflow_since is None:
+            self.overflow_since = now
+        elif now - self.overflow_since > self.policy.grace:
+            return False, True
+
+        if self.policy.on_overflow == "disconnect":
+            if self.policy.grace <= 0:
+                return False, True
+            return False, False
+
+        # drop_oldest: jobs (downloads in progress) are never dropped
+        jobs = []
+        dropped = 0
+        while self.queue and self._over_limit(size, len(jobs)):
+            item = self.queue.popleft()
+            if callable(item):
+                jobs.append(item)
+                continue
+            self.queued_bytes -= len(item)
+            dropped += 1
+        self.queue.extendleft(reversed(jobs))
+        if dropped:
+            self.policy.record_drop(dropped)
+        return not self._over_limit(size), False
+
+    def sendall(self, data):
+        """Socket-compatible send of already encoded bytes."""
+        if not self.send(bytes(data)):
+            raise ConnectionError(f"Connection to {self.username} is closed")
+
+    def send_control(self, data: dict):
+        """Encodes a message for this connection's protocol and queues it."""
+        self.sendall(encode_frame(data, self.protocol, self.compress))
+
+    def send_file(self, filepath, header, block=True, offset=0, count=None):
+        """Queues the header message and the raw bytes of a file (or count bytes
+        from offset) behind everything already queued.
+
+        Both go in one job, so the slow-consumer policy keeps or refuses them
+        together and the client never gets file bytes without their header.
+        """
+        frame = encode_frame(header, self.protocol, self.compress)
+        return self.send(lambda: self._write_file(filepath, frame, offset, count), block=block)
+
+    def send_acked(self, data, on_written, block=True):
+        """Queues a message as a job, which the slow-consumer policy never drops, and
+        calls on_written() from the writer once it is written to the socket.
+
+        Returns False if the connection is closed or the job is refused.
+        """
+        frame = encode_frame(data, self.protocol, self.compress)
+        return self.send(lambda: self._write_acked(frame, on_written), block=block)
+
+    def close(self, flush=False):
+        """Stops accepting frames. With flush=True the writer sends what is queued first."""
+        with self.cond:
+            self.closed = True
+            if not flush:
+                self.queue.clear()
+                self.queued_bytes = 0
+            self.cond.notify_all()
+        self._wake_writer()
+        if not flush:
+            self._close_socket()
+        # file transfers end with the session that authorised them
+        for data_conn in list(self.data_conns):
+            data_conn.close(flush)
+
+    def _take_frames(self):
+        """Pops the next batch: a list of frames, [job], [] if idle, or None once closed and drained."""
+        with self.cond:
+            if not self.queue:
+                return None if self.closed else []
+            if callable(self.queue[0]):
+                batch = [self.queue.popleft()]
+            else:
+                batch = []
+                size = 0
+                while self.queue and not callable(self.queue[0]) and size < WRITE_BATCH_BYTES:
+                    frame = self.queue.popleft()
+                    batch.append(frame)
+                    size += len(frame)
+                self.queued_bytes -= size
+            if not self._over_limit(0):
+                self.overflow_since = None
+            self.cond.notify_all()
+            return batch
+
+    def _wake_writer(self):
+        # the thread writer waits on self.cond, which send() already notified
+        pass
+
+    def _write_acked(self, frame, on_written):
+        self.sock.sendall(frame)
+        on_written()
+
+    def _write_file(self, filepath, header, offset=0, count=None):
+        self.sock.sendall(header)
+        with open(filepath, "rb") as f:
+            if USE_SENDFILE:
+                self.sock.sendfile(f, offset, count)
+                return
+            f.seek(offset)
+            buf = bytearray(FILE_SEND_BUFFER)
+            view = memoryview(buf)
+            remaining = count if count is not None else float("inf")
+            while remaining > 0 and (n := f.readinto(view[:min(len(buf), remaining)])):
+                self.sock.sendall(view[:n])
+                remaining -= n
+
+    def _write_loop(self):
+        try:
+            while True:
+                with self.cond:
+                    while not self.queue and not self.closed:
+                        self.cond.wait()
+                batch = self._take_frames()
+                if batch is None:
+                    break
+                if batch and callable(batch[0]):
+                    batch[0]()
+                elif batch:
+                    self.sock.sendall(b"".join(batch))
+        except Exception as e:
+            if not self.closed:
+                print(f"[SERVER] Writer for {self.username} stopped: {e}")
+        finally:
+            with self.cond:
+                self.closed = True
+                self.queue.clear()
+                self.queued_bytes = 0
+                self.cond.notify_all()
+            self._close_socket()
+
+    def _close_socket(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        try:
+            self.sock.close()
+        except:
+            pass
+
+# =========================
+# Uploads
+# =========================
+class Upload:
+    """An upload streamed into a temp file and hashed as it arrives.
+
+    commit() moves it into the content store under its SHA-256 (or just
+    drops it if that content is already stored), so a half-written file is
+    never listed or downloaded; abort() removes the temp file. A resumable
+    upload is given a fixed tmp_path instead: it continues from whatever is
+    already there, and abort() keeps it for the next attempt.
+
+    With sha256, commit() refuses content that hashes to anything else and
+    discards it, so a bad resume starts over next time.
+    """
+    def __init__(self, files_dir, filename, filesize, tmp_path=None, sha256=None):
+        self.files_dir = files_dir
+        self.filename = filename
+        self.filesize = filesize
+        self.sha256 = sha256
+        self.saved_name = None
+        self.digest = hashlib.sha256()
+        self.resumable = tmp_path is not None
+        self.done = False
+        if self.resumable:
+            self.tmp_path = tmp_path
+            self.file = open(tmp_path, "a+b")
+            if self.file.tell() > filesize:
+                self.file.truncate(0)
+            # hash what an earlier attempt already delivered
+            self.file.seek(0)
+            while chunk := self.file.read(FILE_CHUNK_SIZE):
+                self.digest.update(chunk)
+        else:
+            fd, self.tmp_path = tempfile.mkstemp(dir=files_dir, prefix=UPLOAD_TMP_PREFIX)
+            self.file = os.fdopen(fd, "wb")
+        self.remaining = filesize - self.file.tell()
+
+    @property
+    def offset(self):
+        return self.filesize - self.remaining
+
+    def write(self, data):
+        self.file.write(data)
+        self.digest.update(data)
+        self.remaining -= len(data)
+
+    def commit(self):
+        self.file.close()
+        saved_name = self.digest.hexdigest()
+        if self.sha256 is not None and saved_name != self.sha256:
+            os.remove(self.tmp_path)
+            self.done = True
+            raise ValueError(f"{self.filename} does not match the sha256 it was sent with.")
+        self.saved_name = saved_name
+        stored_path = os.path.join(self.files_dir, self.saved_name)
+        if os.path.exists(stored_path):
+            os.remove(self.tmp_path)
+        else:
+            os.replace(self.tmp_path, stored_path)
+        self.done = True
+
+    def abort(self):
+        if self.done:
+            return
+        self.file.close()
+        if self.resumable:
+            return
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
 
 # =========================
-# Utility functions for JSON protocol
+# File catalog
 # =========================
-def send_control(sock, data: dict):
-    """Send a JSON control message with fixed header length"""
-    j = json.dumps(data).encode('utf-8')
-    header = f"{len(j):010d}".encode('utf-8')
-    sock.sendall(header + j)
-
-def recv_all(sock, n):
-    """Receive exactly n bytes"""
-    buf = bytearray()
-    while len(buf) < n:
-        chunk = sock.recv(n - len(buf))
-        if not chunk:
-            raise ConnectionError("Connection closed")
-        buf.extend(chunk)
-    return bytes(buf)
-
-def recv_control(sock):
-    """Receive a JSON control message"""
-    header = recv_all(sock, 10)
-    length = int(header.decode('utf-8'))
-    j = recv_all(sock, length)
-    return json.loads(j.decode('utf-8'))
+class FileCatalog:
+    """Every stored file, loaded from the files table once and kept current in memory.
+
+    Each change bumps `version` and is remembered as a FILE_LIST_DELTA, so a
+    client that already has version N only needs the deltas after it. Not
+    locked itself: ChatServer.catalog_lock guards it.
+    """
+    def __init__(self, files=(), history=CATALOG_HISTORY):
+        self.files = {f["file_id"]: f for f in files}  # {file_id: FILE_LIST entry}
+        # from the clock, like the list versions: a version from before a
+        # restart never matches the new catalog's
+        self.version = LIST_VERSION_START
+        self.deltas = deque(maxlen=history)
+
+    def snapshot(self):
+        return {"type": "FILE_LIST", "version": self.version, "files": list(self.files.values())}
+
+    def _change(self, added, removed):
+        self.version += 1
+        delta = {"type": "FILE_LIST_DELTA", "version": self.version, "added": added, "removed": removed}
+        self.deltas.append(delta)
+        return delta
+
+    def add(self, entry):
+        """Adds a file and returns the delta, or None if it is already listed."""
+        if entry["file_id"] in self.files:
+            return None
+        self.files[entry["file_id"]] = entry
+        return self._change([entry], [])
+
+    def deltas_since(self, version):
+        """The deltas that bring `version` up to date, or None if some are no longer kept."""
+        if version == self.version:
+            return []
+        if not self.deltas or not self.deltas[0]["version"] - 1 <= version < self.version:
+            return None
+        return [delta for delta in self.deltas if delta["version"] > version]
 
 # =========================
 # Chat Server
 # =========================
+# "thread" runs one OS thread per client, "asyncio" serves every client from one event loop
+SERVER_ENGINE = os.environ.get("CHAT_SERVER_ENGINE", "thread")
+
+def create_server(host="0.0.0.0", port=5001, engine=None, policy=None):
+    """Builds a chat server for the selected engine ("thread" or "asyncio")."""
+    engine = engine or SERVER_ENGINE
+    if engine == "thread":
+        return ChatServer(host, port, policy)
+    if engine == "asyncio":
+        from async_server import AsyncChatServer
+        return AsyncChatServer(host, port, policy)
+    raise ValueError(f"Unknown server engine: {engine}")
+
 class ChatServer:
-    def __init__(self, host="0.0.0.0", port=5001):
+    def __init__(self, host="0.0.0.0", port=5001, policy=None):
         self.host = host
         self.port = port
-        self.clients = {}  # {username: sock}
+        self.clients = {}  # {username: ClientConnection}
+        # outbound queue limits and drop/eviction counters for self.clients
+        self.policy = policy or SlowConsumerPolicy()
         self.lock = threading.Lock()
         self.files_dir = "server_files"
         os.makedirs(self.files_dir, exist_ok=True)
+        self.max_upload_size = MAX_UPLOAD_SIZE
+        self._remove_partial_uploads()
+        self.data_tokens = {}  # {token: (ClientConnection, expiry on time.monotonic())}
         self.running = False
         self.server_socket = None
         self.server_thread = None
@@ -50,8 +469,16 @@ class ChatServer:
         #setuping the database!
         models.init_db()
 
-
-        self.available_files = self._get_file_list_from_dir() 
+        self._import_legacy_files()
+        self.catalog = FileCatalog(self._get_file_list())
+        # held while the catalog changes and the change is queued, so every
+        # client sees the deltas in version order
+        self.catalog_lock = threading.Lock()
+        # "users" changes with the users table, "groups" with groups or memberships
+        self.list_versions = {"users": LIST_VERSION_START, "groups": LIST_VERSION_START}
+        self.reply_cache = {}  # {reply type: (version, message, {(protocol, compress): frame})}
+        self.reply_cache_lock = threading.Lock()
+        models.add_change_listener(self.on_db_change)
 
     def autenticate_user(self, username, password):
         _, hashed_password, role = models.get_user_by_username(username)
@@ -71,30 +498,193 @@ class ChatServer:
         self.send_private_update(msg, "login"+username, type)
 
 
-    def _get_file_list_from_dir(self):
-        files = []
+    def _get_file_list(self):
+        return [{"file_id": f["file_id"], "filename": f["filename"], "filesize": f["filesize"]}
+                for f in models.get_all_files_db()]
+
+    def _import_legacy_files(self):
+        """Moves files saved under their upload name by older versions into the content store."""
         for filename in os.listdir(self.files_dir):
             filepath = os.path.join(self.files_dir, filename)
-            if os.path.isfile(filepath):
-                files.append({"filename": filename, "filesize": os.path.getsize(filepath)})
-        return files
+            if filename.startswith(".") or is_content_name(filename) or not os.path.isfile(filepath):
+                continue
+            saved_name = file_sha256(filepath)
+            filesize = os.path.getsize(filepath)
+            stored_path = os.path.join(self.files_dir, saved_name)
+            if os.path.exists(stored_path):
+                os.remove(filepath)
+            else:
+                os.replace(filepath, stored_path)
+            models.add_file_db(filename, models.ADMIN_USERNAME, filesize, saved_name)
+            print(f"[SERVER] Imported {filename} into the file store.")
     
-    def request_get_historical_messages_db(self, user1, user2):
-        messages = models.get_historical_messages_db(user1, user2)
-        self.send_private_update(messages, user1, type="RECV_HISTORY")
+    def request_get_historical_messages_db(self, user1, user2, limit=None, before_message_id=None):
+        """Sends user1 their history with user2: all of it, or with `limit` one page of it.
+
+        A page holds the newest `limit` messages before `before_message_id`;
+        its "cursor" is the before_message_id of the next older page, or None.
+        """
+        if limit is None:
+            messages = models.get_historical_messages_db(user1, user2)
+            self.send_private_update(messages, user1, type="RECV_HISTORY")
+            return
+        limit = max(1, min(int(limit), MAX_HISTORY_PAGE))
+        messages, cursor = models.get_history_page_db(user1, user2, limit, before_message_id)
+        self.send_private_update(messages, user1, type="RECV_HISTORY", user2=user2,
+                                 before_message_id=before_message_id, cursor=cursor)
+
+
+    def search_messages(self, username, query, limit=None, offset=0):
+        """Answers SEARCH with one page of username's own messages matching `query`, best first."""
+        with self.lock:
+            conn = self.clients.get(username)
+        if conn is None:
+            return
+        limit = max(1, min(int(limit or MAX_SEARCH_RESULTS), MAX_SEARCH_RESULTS))
+        results, next_offset = models.search_messages_db(username, query, limit, max(0, int(offset)))
+        conn.send_control({"type": "SEARCH_RESULTS", "query": query, "results": results, "next_offset": next_offset})
+
+    def request_get_all_users(self, username, version=None):
+        current = self.list_versions["users"]
+        if version == current:
+            self.send_not_modified(username, "RecAllUser", current)
+            return
+        self.send_shared_reply(username, "RecAllUser", current, models.get_all_users_db)
+
+    def request_get_all_groups(self, username, version=None):
+        current = self.list_versions["groups"]
+        if version == current:
+            self.send_not_modified(username, "RECALLGROUPS", current)
+            return
+        self.send_shared_reply(username, "RECALLGROUPS", current, models.get_all_groups_db)
+
+    def request_get_user_groups(self, username, version=None):
+        current = self.list_versions["groups"]
+        if version == current:
+            self.send_not_modified(username, "RECUSERGROUPS", current)
+            return
+        self.send_private_update(msg=models.get_user_groups_db(username), recipient=username, type="RECUSERGROUPS", version=current)
+
+    def send_not_modified(self, username, list_type, version):
+        """Tells a client its copy of a list (named by its reply type) is still current."""
+        with self.lock:
+            conn = self.clients.get(username)
+        if conn:
+            conn.send_control({"type": "NOT_MODIFIED", "list": list_type, "version": version})
 
+    def bump_list_version(self, name):
+        with self.lock:
+            self.list_versions[name] += 1
+        for reply_type in SHARED_REPLIES[name]:
+            self.invalidate_reply(reply_type)
+
+    def shared_reply(self, conn, reply_type, version, build):
+        """Returns the encoded reply for `version` in conn's wire format.
+
+        `build()` makes the message; it runs once per version and the result is
+        encoded once per wire format, however many clients ask.
+        """
+        with self.reply_cache_lock:
+            entry = self.reply_cache.get(reply_type)
+            if entry is None or entry[0] != version:
+                entry = self.reply_cache[reply_type] = (version, build(), {})
+            wire = (conn.protocol, conn.compress)
+            frame = entry[2].get(wire)
+            if frame is None:
+                frame = entry[2][wire] = encode_frame(entry[1], *wire)
+        return frame
+
+    def invalidate_reply(self, reply_type):
+        with self.reply_cache_lock:
+            self.reply_cache.pop(reply_type, None)
+
+    def send_shared_reply(self, username, reply_type, version, query):
+        """Sends a list reply every client gets alike ({"text": query(), "version"}) from the cache."""
+        with self.lock:
+            conn = self.clients.get(username)
+        if conn is None:
+            return
+        build = lambda: {"type": reply_type, "username": "server", "text": query(), "version": version}
+        try:
+            conn.sendall(self.shared_reply(conn, reply_type, version, build))
+        except ConnectionError:
+            print(f"[PM] Failed to send {reply_type} to {username}.")
+
+    def subscribe(self, username, topics):
+        """Answers SUBSCRIBE: a snapshot per topic now, pushed changes from then on.
+
+        The topic is added before the snapshot is read, so a change in between
+        arrives twice rather than not at all; clients apply events idempotently.
+        """
+        with self.lock:
+            conn = self.clients.get(username)
+        if conn is None:
+            return
+        for topic in topics:
+            if topic not in SUBSCRIBE_TOPICS:
+                conn.send_control({"type": "ERROR", "message": f"Unknown topic: {topic}"})
+                continue
+            conn.topics.add(topic)
+            if topic == "users":
+                self.request_get_all_users(username)
+            elif topic == "presence":
+                conn.send_control({"type": "ONLINE_USERS", "users": sorted(self.get_online_usernames())})
+            elif topic == "groups":
+                self.request_get_all_groups(username)
+            elif topic == "my_groups":
+                self.request_get_user_groups(username)
 
-    def request_get_all_users(self, username):
-        self.send_private_update(msg=models.get_all_users_db(), recipient=username, type="RecAllUser")
+    def publish(self, topic, msg):
+        self.broadcast_control(msg, lambda conn: topic in conn.topics)
 
-    def request_get_all_groups(self, username):
-        self.send_private_update(msg=models.get_all_groups_db(), recipient=username, type="RECALLGROUPS")
+    def on_db_change(self, event, username=None, group_name=None):
+        """models change listener: bumps list versions and pushes the change to subscribers."""
+        self.bump_list_version("users" if event.startswith("user_") else "groups")
+        if event == "user_added":
+            self.publish("users", {"type": "USER_ADDED", "username": username})
+        elif event == "user_removed":
+            self.publish("users", {"type": "USER_REMOVED", "username": username})
+        elif event == "group_added":
+            self.publish("groups", {"type": "GROUP_ADDED", "group": group_name})
+        elif event in ("member_added", "member_removed"):
+            with self.lock:
+                conn = self.clients.get(username)
+            if conn and "my_groups" in conn.topics:
+                type = "GROUP_JOINED" if event == "member_added" else "GROUP_LEFT"
+                conn.send_control({"type": type, "group": group_name})
+
+    # =========================
+    # Groups
+    # =========================
+    def send_group_message(self, username, group_name, text):
+        """Stores a GMSG once and queues it, encoded once per wire format, for every online member.
+
+        Membership comes from the models membership index, not a query.
+        """
+        if not models.is_group_member(username, group_name):
+            self.send_error(username, f"You are not a member of {group_name}.")
+            return
+        recipients = [member for member in models.get_group_members_db(group_name) if member != username]
+        models.add_message_db(username, None, text, is_group=True, group_name=group_name)
+        self.multicast_control({"type": "GMSG_RECV", "username": username, "group": group_name, "text": text}, recipients)
+
+    def request_get_group_history(self, username, group_name, limit=None, before_message_id=None):
+        """Sends a member one page of a group's messages; see request_get_historical_messages_db."""
+        if not models.is_group_member(username, group_name):
+            self.send_error(username, f"You are not a member of {group_name}.")
+            return
+        limit = max(1, min(int(limit or MAX_HISTORY_PAGE), MAX_HISTORY_PAGE))
+        messages, cursor = models.get_group_history_page_db(group_name, limit, before_message_id)
+        self.send_private_update(messages, username, type="RECV_HISTORY", group=group_name,
+                                 before_message_id=before_message_id, cursor=cursor)
 
-    def request_get_user_groups(self, username):
-        print(username)
-        self.send_private_update(msg=models.get_user_groups_db(username), recipient=username, type="RECUSERGROUPS")
+    def send_error(self, username, message):
+        with self.lock:
+            conn = self.clients.get(username)
+        if conn:
+            conn.send_control({"type": "ERROR", "message": message})
 
-    def send_private_update(self, msg, recipient, type):
+    def send_private_update(self, msg, recipient, type, **extra):
         recipient_socket = None
         with self.lock:
             recipient_socket = self.clients.get(recipient)
@@ -105,7 +695,8 @@ class ChatServer:
             
             try:
                 msg = {"type": type, "username": "server", "text": msg}
-                send_control(recipient_socket, msg)
+                msg.update(extra)
+                recipient_socket.send_control(msg)
                 print(f"[PM] Message delivered to online user: {recipient}")
             except:
                 # If sending failed, the user might have just disconnected.
@@ -129,6 +720,10 @@ class ChatServer:
         
         return users_with_status
     
+    def get_send_stats(self):
+        """Returns how many frames were dropped, how many slow consumers were evicted and the latest of them."""
+        return self.policy.stats()
+
     def get_online_usernames(self):
         """Returns a thread-safe set of currently online usernames."""
         with self.lock:
@@ -141,30 +736,22 @@ class ChatServer:
             
     def kick_by_username(self, username_to_kick):
         with self.lock:
-            client_socket = self.clients.get(username_to_kick)
-            
-            if client_socket:
-                kicked_successfully = False
-                try:
-                    # sending kick message
-                    send_control(client_socket, {"type": "KICKED", "message": "You have been kicked by the admin."})
-                    
-                    # closing the socket
-                    time.sleep(0.1) 
-                    client_socket.shutdown(socket.SHUT_RDWR)
-                    client_socket.close()
-                    kicked_successfully = True
-
-                except Exception as e:
-                    print(f"[SERVER ERROR] Error during socket closure for {username_to_kick}: {e}")
-                    
-                finally:
-                    #removing from list
-                    if username_to_kick in self.clients:
-                        del self.clients[username_to_kick]
-                        # self.broadcast_message(f"[{username_to_kick} was kicked by admin]", "SERVER")
-                        print(f"[SERVER] Removed client {username_to_kick} from list.")
-                        return True
+            #removing from list
+            conn = self.clients.pop(username_to_kick, None)
+
+        if conn:
+            try:
+                # sending kick message
+                conn.send_control({"type": "KICKED", "message": "You have been kicked by the admin."})
+            except Exception as e:
+                print(f"[SERVER ERROR] Error during socket closure for {username_to_kick}: {e}")
+
+            # the writer closes the socket once the kick message is out
+            conn.close(flush=True)
+            self.publish("presence", {"type": "USER_LEFT", "username": username_to_kick})
+            # self.broadcast_message(f"[{username_to_kick} was kicked by admin]", "SERVER")
+            print(f"[SERVER] Removed client {username_to_kick} from list.")
+            return True
         return False
            
     def send_private(self, msg, username, recipient):
@@ -180,152 +767,448 @@ class ChatServer:
         with self.lock:
             recipient_socket = self.clients.get(recipient)
 
-        # 2. If online, attempt to send the message over the socket
-        if recipient_socket:
-            print(f"Attempting to send private message from {username} to {recipient}: {msg}")
-            
-            try:
-                msg = {"type": "PMSG_RECV", "username": username, "text": msg}
-                send_control(recipient_socket, msg)
-                print(f"[PM] Message delivered to online user: {recipient}")
-            except:
-                # If sending failed, the user might have just disconnected.
-                # The handle_client loop will eventually clean this up, 
-                # but we can also trigger a cleanup here.
-                print(f"[PM] Failed to send message to {recipient}. Marking as offline.")
-                # We will rely on the main thread/loop to eventually call remove_client. 
-                # For a private message, we just log it as is.
-        else:
-            print(f"[PM] User {recipient} is offline. Message will be logged only.")
-
-        
-        print(recipient)
-        #saving the messsage to DataBase
-        models.add_message_db(
+        # 2. Store it as undelivered; it counts as delivered only once the
+        # recipient's writer has put it on the socket, and otherwise waits
+        # for their next HELLO like any offline message
+        message_id = models.add_message_db(
             sender_username=username,
             recipient_username=recipient,
-            text=msg["text"] if recipient_socket else msg,
-            is_group=False
+            text=msg,
+            is_group=False,
+            delivered=False
         )
-
         print("[PM] Message added to DB.")
 
+        # 3. If online, attempt to send the message over the socket
+        if recipient_socket and message_id is not None:
+            print(f"Attempting to send private message from {username} to {recipient}: {msg}")
+            live = {"type": "PMSG_RECV", "username": username, "text": msg, "message_id": message_id}
+            delivered = [{"message_id": message_id, "sender": username}]
+            # never waits on a slow recipient; a refused message just stays undelivered
+            if recipient_socket.send_acked(live, lambda: models.mark_delivered_db(recipient, delivered), block=False):
+                print(f"[PM] Message queued for online user: {recipient}")
+            else:
+                print(f"[PM] Failed to send message to {recipient}. It will be pushed when they reconnect.")
+        elif not recipient_socket:
+            print(f"[PM] User {recipient} is offline. Message will be pushed when they reconnect.")
+
+    def deliver_missed(self, username):
+        """Pushes the private messages username missed while offline, with their delivery cursors.
+
+        Everything fits one MISSED_MESSAGES frame unless more than
+        MAX_MISSED_MESSAGES are waiting. The messages count as delivered only
+        once their frame is written to the socket; anything not written is
+        pushed again on the next HELLO.
+        """
+        with self.lock:
+            conn = self.clients.get(username)
+        if conn is None:
+            return
+        cursors = models.get_delivery_cursors_db(username)
+        after_message_id = 0
+        while True:
+            messages = models.get_undelivered_messages_db(username, MAX_MISSED_MESSAGES, after_message_id)
+            if not messages:
+                return
+            # the cursors as they will be once these are delivered
+            for msg in messages:
+                cursor = cursors.setdefault(msg["sender"], {"delivered": 0, "read": 0})
+                cursor["delivered"] = max(cursor["delivered"], msg["message_id"])
+            missed = {"type": "MISSED_MESSAGES", "messages": messages, "cursors": cursors}
+            if not conn.send_acked(missed, lambda messages=messages: models.mark_delivered_db(username, messages)):
+                print(f"[PM] Could not push missed messages to {username}; they stay undelivered.")
+                return
+            print(f"[PM] Pushing {len(messages)} missed messages to {username}")
+            if len(messages) < MAX_MISSED_MESSAGES:
+                return
+            after_message_id = messages[-1]["message_id"]
+
     def broadcast_admin(self, message):
         self.broadcast_message(message, "ADMIN")
 
     def broadcast_message(self, message, sender):
         """ارسال پیام به تمام کلاینت‌های متصل، شامل ادمین."""
         msg = {"type": "MSG", "username": sender, "text": message}
-        j = json.dumps(msg).encode('utf-8')
-        header = f"{len(j):010d}".encode('utf-8')
-        
-        with self.lock:
-            for username, client_socket in list(self.clients.items()): 
-                # --- [تغییر کلیدی: شرط حذف شد تا ادمین هم پیام‌ها را ببیند] ---
-                try:
-                    client_socket.sendall(header + j)
-                except:
-                    self.remove_client(username, client_socket)
+        self.broadcast_control(msg)
                         
-    def broadcast_file_list(self):
-        self.available_files = self._get_file_list_from_dir()
-        file_msg = {"type": "FILE_LIST", "files": self.available_files}
+    def broadcast_file_list(self, delta):
+        """Pushes a catalog change: the delta to clients following it, the whole list to older clients.
+
+        Call with catalog_lock held.
+        """
+        self.broadcast_control(delta, lambda conn: conn.file_deltas)
+        with self.lock:
+            legacy = any(not conn.file_deltas for conn in self.clients.values())
+        if legacy:
+            self.broadcast_control(self.catalog.snapshot(), lambda conn: not conn.file_deltas)
+
+    def send_file_list(self, username, version=None):
+        """Answers GET_FILE_LIST: the deltas after `version` if they are all kept, else the whole list."""
+        with self.lock:
+            conn = self.clients.get(username)
+        if conn is None:
+            return
+        with self.catalog_lock:
+            conn.file_deltas = True
+            deltas = self.catalog.deltas_since(version) if version is not None else None
+            if deltas is None:
+                conn.sendall(self.shared_reply(conn, "FILE_LIST", self.catalog.version, self.catalog.snapshot))
+            for msg in deltas or ():
+                conn.send_control(msg)
+
+    def file_added(self, entry):
+        with self.catalog_lock:
+            delta = self.catalog.add(entry)
+            if delta:
+                self.invalidate_reply("FILE_LIST")
+                self.broadcast_file_list(delta)
+
+    def broadcast_control(self, msg, accept=None):
+        """Queues a message on every connection (or those `accept` returns True for) without waiting on any socket.
+
+        The message is encoded once per wire format, not once per client.
+        """
+        with self.lock:
+            targets = list(self.clients.items())
+
+        # --- [تغییر کلیدی: شرط حذف شد تا ادمین هم پیام‌ها را ببیند] ---
+        if accept is not None:
+            targets = [(username, conn) for username, conn in targets if accept(conn)]
+        self._queue_encoded(msg, targets)
+
+    def multicast_control(self, msg, usernames):
+        """Queues a message for those of `usernames` that are online, like broadcast_control."""
+        with self.lock:
+            targets = [(username, self.clients[username]) for username in usernames if username in self.clients]
+        self._queue_encoded(msg, targets)
+
+    def _queue_encoded(self, msg, targets):
+        frames = {}
+        for username, conn in targets:
+            wire = (conn.protocol, conn.compress)
+            frame = frames.get(wire)
+            if frame is None:
+                frame = frames[wire] = encode_frame(msg, *wire)
+            if not conn.send(frame):
+                self.remove_client(username, conn)
+
+    def dispatch_message(self, username, msg):
+        """Handles one control message that does not carry raw file bytes.
+
+        Shared by every server engine; `username` is the connection's HELLO name.
+        """
+        if msg["type"] == "LOGIN_REQUEST":
+            self.autenticate_user(msg["username"], msg["password"])
+
+        elif msg["type"] == "GetAllUser":
+            self.request_get_all_users(username=msg["username"], version=msg.get("version"))
         
+        elif msg["type"] == "GETALLGROUPS":
+            self.request_get_all_groups(username=msg["username"], version=msg.get("version"))
+
+        elif msg["type"] == "GETUSERGROUPS":
+            self.request_get_user_groups(username = msg["username"], version=msg.get("version"))
+
+        elif msg["type"] == "get_status":
+            self.check_status(msg["admin_username"], msg["username"])
+
+        elif msg["type"] == "GET_HISTORY":
+            if "group" in msg:
+                self.request_get_group_history(username, msg["group"], msg.get("limit"), msg.get("before_message_id"))
+            else:
+                self.request_get_historical_messages_db(msg["user1"], msg["user2"], msg.get("limit"), msg.get("before_message_id"))
+
+        elif msg["type"] == "PMSG":
+            text = msg["text"]
+            sender = msg["username"]
+            recipient = msg["recipient"]
+            self.send_private(text, sender, recipient)
+            
+        elif msg["type"] == "GMSG":
+            self.send_group_message(username, msg["group"], msg["text"])
+
+        elif msg["type"] == "MSG":
+            # اگر ادمین پیام فرستاده، نیاز به برودکست نیست، فقط برای نمایش در پنل ادمین
+            # if username == "admin": 
+            #     continue
+            self.broadcast_message(msg["text"], username)
+
+        elif msg["type"] == "GET_DATA_TOKEN":
+            self.issue_data_token(username)
+
+        elif msg["type"] == "GET_FILE_LIST":
+            self.send_file_list(username, msg.get("version"))
+
+        elif msg["type"] == "SEARCH":
+            # scoped to the connection's own user, whatever the message claims
+            self.search_messages(username, msg["query"], msg.get("limit"), msg.get("offset", 0))
+
+        elif msg["type"] == "SUBSCRIBE":
+            self.subscribe(username, msg.get("topics", ()))
+
+        elif msg["type"] == "MARK_READ":
+            models.mark_read_db(username, msg["peer"], int(msg["message_id"]))
+
+    # =========================
+    # Data connections
+    # =========================
+    # File bytes can go over a second connection so they never hold up chat
+    # traffic: the client asks for a token on its control connection, opens a
+    # new connection with DATA_HELLO {"token"} and then sends FILE_META /
+    # GET_FILE there exactly as it would on the control connection.
+
+    def issue_data_token(self, username):
+        """Sends username a single-use token for opening one data connection."""
+        token = secrets.token_hex(16)
+        now = time.monotonic()
+        with self.lock:
+            conn = self.clients.get(username)
+            if conn is None:
+                return
+            self.data_tokens = {t: v for t, v in self.data_tokens.items() if v[1] > now}
+            self.data_tokens[token] = (conn, now + DATA_TOKEN_TTL)
+        conn.send_control({"type": "DATA_TOKEN", "token": token, "ttl": DATA_TOKEN_TTL})
+
+    def attach_data_connection(self, conn, hello_msg):
+        """Binds a DATA_HELLO connection to the session that issued its token. Returns False if the token is no good."""
+        with self.lock:
+            owner, expires = self.data_tokens.pop(hello_msg.get("token"), (None, 0))
+            if owner is None or expires < time.monotonic() or self.clients.get(owner.username) is not owner:
+                return False
+            conn.username = owner.username
+            conn.owner = owner
+            conn.protocol = owner.protocol
+            conn.compress = owner.compress
+            owner.data_conns.add(conn)
+        # like HELLO_ACK on the control connection, the first frame is v1
+        ack = {"type": "HELLO_ACK", "protocol": conn.protocol}
+        if conn.compress:
+            ack["compression"] = "zlib"
+        conn.send(encode_frame(ack, PROTOCOL_V1))
+        return True
+
+    def detach_data_connection(self, conn):
+        with self.lock:
+            conn.owner.data_conns.discard(conn)
+        # let a download that is still queued finish going out
+        conn.close(flush=True)
+
+    def serve_data(self, reader, conn):
+        """Serves file transfers on an attached data connection until BYE."""
+        while True:
+            msg = reader.recv_control()
+            if msg["type"] == "FILE_META":
+                if not self.receive_file(reader, conn, msg):
+                    return
+            elif msg["type"] == "GET_FILE":
+                self.send_file(conn, msg)
+            elif msg["type"] == "BYE":
+                return
+            else:
+                conn.send_control({"type": "ERROR", "message": f"{msg['type']} is not allowed on a data connection."})
+
+    def _remove_partial_uploads(self):
+        """Deletes temp files left by a crash, and resumable ones nobody came back for."""
+        expired = time.time() - PARTIAL_UPLOAD_TTL
+        for filename in os.listdir(self.files_dir):
+            if not filename.startswith(UPLOAD_TMP_PREFIX):
+                continue
+            filepath = os.path.join(self.files_dir, filename)
+            try:
+                if not filename.endswith(PARTIAL_UPLOAD_SUFFIX) or os.path.getmtime(filepath) < expired:
+                    os.remove(filepath)
+            except OSError:
+                pass
+
+    def _partial_upload_path(self, username, filename, filesize, sha256=None):
+        # a file that changed between attempts has another sha256, so it
+        # does not continue the old partial
+        key = hashlib.sha1(f"{username}\0{filename}\0{filesize}\0{sha256}".encode('utf-8')).hexdigest()
+        return os.path.join(self.files_dir, UPLOAD_TMP_PREFIX + key + PARTIAL_UPLOAD_SUFFIX)
+
+    def open_upload(self, conn, msg):
+        """Starts receiving the file announced by FILE_META, or returns None after telling the client why not.
+
+        The client streams the bytes right after FILE_META, so a refused
+        upload leaves the connection unusable: it is removed once the error
+        has been flushed.
+
+        With "resume": true the client waits instead, and is told through
+        FILE_RESUME how many bytes from an earlier attempt the server already
+        has; it then sends only the rest. If it also sends the file's "sha256",
+        the partial is kept for that content only and the finished upload is
+        checked against it.
+        """
+        filename = msg["filename"]
+        filesize = int(msg["filesize"])
+        sha256 = msg.get("sha256")
+        if isinstance(sha256, str):
+            sha256 = sha256.lower()
+        if filename != os.path.basename(filename) or filename.startswith("."):
+            error = f"Invalid file name: {filename}"
+        elif not 0 <= filesize <= self.max_upload_size:
+            error = f"File {filename} is larger than the {self.max_upload_size} byte upload limit."
+        elif sha256 is not None and not is_content_name(sha256):
+            error = f"Invalid sha256 for {filename}."
+        elif msg.get("resume"):
+            upload = Upload(self.files_dir, filename, filesize,
+                            self._partial_upload_path(conn.username, filename, filesize, sha256), sha256)
+            conn.send_control({"type": "FILE_RESUME", "filename": filename, "offset": upload.offset})
+            return upload
+        else:
+            return Upload(self.files_dir, filename, filesize, sha256=sha256)
+        conn.send_control({"type": "ERROR", "message": error})
+        if conn.owner is None:
+            self.remove_client(conn.username, conn, flush=True)
+        return None
+
+    def receive_file(self, reader, conn, msg):
+        """Streams an upload to disk. Returns False if it was refused and the connection must close."""
+        upload = self.open_upload(conn, msg)
+        if upload is None:
+            return False
+        try:
+            buf = memoryview(bytearray(FILE_CHUNK_SIZE))
+            while upload.remaining > 0:
+                n = reader.readinto(buf[:min(len(buf), upload.remaining)])
+                upload.write(buf[:n])
+            self.store_upload(conn.username, upload)
+        finally:
+            upload.abort()
+        return True
+
+    def store_upload(self, username, upload):
+        """Moves a fully received upload into the content store, records it and announces it."""
+        try:
+            upload.commit()
+        except ValueError as e:
+            self.send_error(username, str(e))
+            return
+        file_id = models.add_file_db(upload.filename, username, upload.filesize, upload.saved_name)
+        if file_id is not None:
+            self.file_added({"file_id": file_id, "filename": upload.filename, "filesize": upload.filesize})
+        self.file_uploaded(username, upload.filename)
+
+    def send_file(self, conn, msg, block=True):
+        """Answers GET_FILE with FILE_SEND and the file behind it.
+
+        The file is picked by "file_id" from FILE_LIST, or else by "filename"
+        (the newest file with that name). An optional "offset" (and "length")
+        asks for just that range, e.g. to finish an interrupted download;
+        FILE_SEND then echoes both and only `length` bytes follow it.
+        """
+        if msg.get("file_id") is not None:
+            record = models.get_file_by_id_db(int(msg["file_id"]))
+        else:
+            record = models.get_file_by_name_db(msg.get("filename"))
+        filename = record["filename"] if record else msg.get("filename", msg.get("file_id"))
+        filepath = os.path.join(self.files_dir, record["saved_name"]) if record else None
+
+        if not filepath or not os.path.isfile(filepath):
+            conn.send_control({"type": "ERROR", "message": f"File {filename} not found on server."})
+            return
+        filesize = os.path.getsize(filepath)
+        reply = {"type": "FILE_SEND", "filename": filename, "filesize": filesize}
+        offset, count = 0, None
+        if "offset" in msg or "length" in msg:
+            offset = int(msg.get("offset", 0))
+            if not 0 <= offset <= filesize:
+                conn.send_control({"type": "ERROR", "message": f"Offset {offset} is outside {filename} ({filesize} bytes)."})
+                return
+            count = filesize - offset
+            if msg.get("length") is not None:
+                count = max(0, min(count, int(msg["length"])))
+            reply["offset"] = offset
+            reply["length"] = count
+        if count == 0:
+            # nothing follows, and sendfile refuses a zero count
+            conn.send_control(reply)
+            return
+        if not conn.send_file(filepath, reply, block=block, offset=offset, count=count):
+            if conn.closed:
+                raise ConnectionError(f"Connection to {conn.username} is closed")
+            conn.send_control({"type": "ERROR", "message": f"Too many transfers queued, ask for {filename} again later."})
+
+    def file_uploaded(self, username, filename):
+        """Announces a completed upload."""
+        self.broadcast_message(f"{username} uploaded file: {filename}", "SERVER")
+
+    def register_client(self, username, conn, hello_msg):
+        """Negotiates the protocol and adds conn to self.clients. Returns False if the name is taken.
+
+        Clients that offer protocol versions in HELLO get a v1 HELLO_ACK naming
+        the chosen one (and the compression, if v2 and both sides have one);
+        older clients get no reply and stay on v1.
+        """
         with self.lock:
-            for username, client_socket in list(self.clients.items()):
-                try:
-                    send_control(client_socket, file_msg)
-                except:
-                    self.remove_client(username, client_socket)
+            if username in self.clients:
+                return False
+            if "protocol" in hello_msg:
+                ack = {"type": "HELLO_ACK", "protocol": choose_protocol(hello_msg["protocol"])}
+                compression = choose_compression(hello_msg.get("compression"))
+                if compression and ack["protocol"] == PROTOCOL_V2:
+                    ack["compression"] = compression
+                # queued before conn is visible to broadcasts, so it is the first frame out
+                conn.send(encode_frame(ack, PROTOCOL_V1))
+                conn.protocol = ack["protocol"]
+                conn.compress = "compression" in ack
+            self.clients[username] = conn
+        self.publish("presence", {"type": "USER_JOIN", "username": username})
+        return True
 
     def handle_client(self, client_socket, address):
         username = None
+        conn = None
+        data_conn = None
+        reader = FrameReader(client_socket)
         try:
-            hello_msg = recv_control(client_socket)
+            hello_msg = reader.recv_control()
+            if hello_msg["type"] == "DATA_HELLO":
+                data_conn = ClientConnection(client_socket, None, self.policy)
+                if not self.attach_data_connection(data_conn, hello_msg):
+                    data_conn = None
+                    send_control(client_socket, {"type": "ERROR", "message": "Invalid or expired data token."})
+                    return
+                reader.protocol = data_conn.protocol
+                data_conn.start()
+                self.serve_data(reader, data_conn)
+                return
             if hello_msg["type"] != "HELLO":
                 return
             
             username = hello_msg["username"]
             print(f"hello {username}")
             
-            with self.lock:
-                if username in self.clients:
-                    send_control(client_socket, {"type": "ERROR", "message": "Username already taken or connected."})
-                    return
-                self.clients[username] = client_socket
+            conn = ClientConnection(client_socket, username, self.policy)
+            if not self.register_client(username, conn, hello_msg):
+                conn = None
+                send_control(client_socket, {"type": "ERROR", "message": "Username already taken or connected."})
+                return
+            reader.protocol = conn.protocol
+            conn.start()
+            self.deliver_missed(username)
 
             # if username != "admin": 
             #     # self.broadcast_message(f"{username} joined", "SERVER")
-            #     send_control(client_socket, {"type": "FILE_LIST", "files": self.available_files}) 
+            #     send_control(client_socket, self.catalog.snapshot()) 
             if username == "admin":
                 print("admin is here")
 
             while True:
-                msg = recv_control(client_socket)
-                
-                if msg["type"] == "LOGIN_REQUEST":
-                    self.autenticate_user(msg["username"], msg["password"])
-                    continue
-
-                elif msg["type"] == "GetAllUser":
-                    self.request_get_all_users(username=msg["username"])
-                    continue
-                
-                elif msg["type"] == "GETALLGROUPS":
-                    self.request_get_all_groups(username=msg["username"])
-                    continue
-
-                elif msg["type"] == "GETUSERGROUPS":
-                    self.request_get_user_groups(username = msg["username"])
-                    continue
-
-                elif msg["type"] == "get_status":
-                    self.check_status(msg["admin_username"], msg["username"])
-
-                elif msg["type"] == "GET_HISTORY":
-                    self.request_get_historical_messages_db(msg["user1"], msg["user2"])
-
-                elif msg["type"] == "PMSG":
-                    text = msg["text"]
-                    sender = msg["username"]
-                    recipient = msg["recipient"]
-                    self.send_private(text, sender, recipient)
-                    
-                elif msg["type"] == "MSG":
-                    # اگر ادمین پیام فرستاده، نیاز به برودکست نیست، فقط برای نمایش در پنل ادمین
-                    # if username == "admin": 
-                    #     continue
-                    self.broadcast_message(msg["text"], username)
-                
-                elif msg["type"] == "FILE_META":
-                    # ... (File Meta logic remains the same)
-                    filename = msg["filename"]
-                    filesize = int(msg["filesize"])
-                    filepath = os.path.join(self.files_dir, filename)
-                    
-                    file_data = recv_all(client_socket, filesize)
-                    with open(filepath, "wb") as f:
-                        f.write(file_data)
-                    
-                    self.broadcast_message(f"{username} uploaded file: {filename}", "SERVER")
-                    self.broadcast_file_list() 
+                msg = reader.recv_control()
+
+                if msg["type"] == "FILE_META":
+                    if not self.receive_file(reader, conn, msg):
+                        return
                     
                 elif msg["type"] == "GET_FILE":
-                    # ... (Get File logic remains the same)
-                    filename = msg["filename"]
-                    filepath = os.path.join(self.files_dir, filename)
-                    
-                    if os.path.exists(filepath):
-                        filesize = os.path.getsize(filepath)
-                        send_control(client_socket, {"type": "FILE_SEND", "filename": filename, "filesize": filesize})
-                        with open(filepath, "rb") as f:
-                            while chunk := f.read(4096):
-                                client_socket.sendall(chunk)
-                    else:
-                        send_control(client_socket, {"type": "ERROR", "message": f"File {filename} not found on server."})
+                    self.send_file(conn, msg)
 
                 elif msg["type"] == "BYE":
                      return
+
+                else:
+                    self.dispatch_message(username, msg)
                     
         # except ConnectionError:
         #     # print(f"error: ConnectionError")
@@ -335,22 +1218,27 @@ class ChatServer:
             print(f"[SERVER ERROR] Error handling client {username}: {e}")
             
         finally:
-            if username:
+            if conn:
                 deluser = username
-                self.remove_client(username, client_socket)
+                self.remove_client(username, conn)
                 print(f"{deluser} has been removed")
+            elif data_conn:
+                self.detach_data_connection(data_conn)
+            else:
+                client_socket.close()
 
-    def remove_client(self, username, client_socket):
-        """Removes a client connection safely."""
+    def remove_client(self, username, conn, flush=False):
+        """Removes a client connection safely. With flush=True queued frames are still sent."""
         with self.lock:
-            if username in self.clients and self.clients[username] == client_socket:
+            if username in self.clients and self.clients[username] is conn:
                 del self.clients[username]
                 # if username != "admin":
                 #     self.broadcast_message(f"{username} left", "SERVER")
-                try:
-                    client_socket.close()
-                except:
-                    pass
+            else:
+                conn = None
+        if conn:
+            conn.close(flush=flush)
+            self.publish("presence", {"type": "USER_LEFT", "username": username})
 
     def start(self):
         if self.running:
@@ -393,15 +1281,16 @@ class ChatServer:
         self.running = False
         
         with self.lock:
-            for username, client_socket in list(self.clients.items()):
-                try:
-                    send_control(client_socket, {"type": "SERVER_CLOSE", "message": "Server is shutting down."})
-                    client_socket.shutdown(socket.SHUT_RDWR)
-                    client_socket.close()
-                except:
-                    pass
+            conns = list(self.clients.values())
             self.clients.clear()
 
+        for conn in conns:
+            try:
+                conn.send_control({"type": "SERVER_CLOSE", "message": "Server is shutting down."})
+            except:
+                pass
+            conn.close(flush=True)
+
         if self.server_socket:
             try:
                 self.server_socket.close()
@@ -409,5 +1298,21 @@ class ChatServer:
                 pass
 
 if __name__ == "__main__":
-    server = ChatServer()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default=SERVER_ENGINE)
+    parser.add_argument("--max-queued-frames", type=int, default=MAX_QUEUED_FRAMES)
+    parser.add_argument("--max-queued-bytes", type=int, default=MAX_QUEUED_BYTES)
+    parser.add_argument("--on-overflow", choices=OVERFLOW_POLICIES, default="drop_oldest")
+    parser.add_argument("--slow-grace", type=float, default=SLOW_CONSUMER_GRACE)
+    parser.add_argument("--max-upload-size", type=int, default=MAX_UPLOAD_SIZE)
+    parser.add_argument("--db-durability", choices=models.DURABILITY_MODES, default=models.DB_DURABILITY)
+    args = parser.parse_args()
+
+    models.DB_DURABILITY = args.db_durability
+
+    policy = SlowConsumerPolicy(args.max_queued_frames, args.max_queued_bytes, args.on_overflow, args.slow_grace)
+    server = create_server(engine=args.engine, policy=policy)
+    server.max_upload_size = args.max_upload_size
     server.start()
\ No newline at end of file
@@ -5,10 +5,11 @@ import ttkbootstrap as ttk
 from ttkbootstrap.window import Window
 from ttkbootstrap.constants import *
 from server import ChatServer
-import threading, json, socket, bcrypt
+import threading, socket, bcrypt
 import models 
 import time
 from ttkbootstrap.scrolled import ScrolledText
+from protocol import FrameReader, send_control
 
 REFRESH_MS = 2000
 
@@ -24,30 +25,6 @@ def hash_password(password):
     hashed_password = bcrypt.hashpw(password_bytes, salt)
     return hashed_password.decode('utf-8')
 
-# توابع Utility: recv_all، recv_control، send_control
-def send_control(sock, data: dict):
-    """Send a JSON control message with a fixed header length"""
-    j = json.dumps(data).encode('utf-8')
-    header = f"{len(j):010d}".encode('utf-8')
-    sock.sendall(header + j)
-
-def recv_all(sock, n):
-    """Receive exactly n bytes"""
-    buf = bytearray()
-    while len(buf) < n:
-        chunk = sock.recv(n - len(buf))
-        if not chunk:
-            raise ConnectionError("Connection closed")
-        buf.extend(chunk)
-    return bytes(buf)
-
-def recv_control(sock):
-    """Receive a JSON control message"""
-    header = recv_all(sock, 10)
-    length = int(header.decode('utf-8'))
-    j = recv_all(sock, length)
-    return json.loads(j.decode('utf-8'))
-
 
 class ServerAdminGUI(ttk.Toplevel):
     def __init__(self, server: ChatServer, host, port, theme_name):
@@ -157,6 +134,7 @@ class ServerAdminGUI(ttk.Toplevel):
         self.client.connect((self.host, self.port))
 
         send_control(self.client, {"type": "HELLO", "username": "admin"})
+        self.reader = FrameReader(self.client)
 
         self.running = True
         threading.Thread(target=self.recv_loop, daemon=True).start()
@@ -319,7 +297,7 @@ class ServerAdminGUI(ttk.Toplevel):
     def recv_loop(self):
         try:
             while self.running:
-                msg = recv_control(self.client)
+                msg = self.reader.recv_control()
 
                 if msg["type"] == "MSG":
                     self.show_msg(f"{msg['username']}: {msg['text']}")